@@ -1,60 +1,282 @@
-from flask import Flask, jsonify, request, render_template
+import atexit
+import math
+import os
+import sys
+import time
+
+from flask import Flask, Response, abort, jsonify, request, render_template, send_from_directory
 import mido
-import pygame
+
+# pypianoの共通モジュールを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pypiano'))
+from active_notes import ActiveNotes
+from audio_setup import LatencyProbe, init_mixer
+from audio_worker import AudioWorker, DelayedSubmitter
+from event_stream import EventBroadcaster
+from grid_model import (DRUM_SAMPLES, IS_DRUM, NOTE_TABLE, PALETTE_IDS, PALETTE_NAMES, GridModel,
+                        palette_table)
+from midi_output import MidiOutput
+from pattern_player import PatternPlayer
+from pattern_store import PatternLibrary
+from sample_bank import SAMPLE_DIR, SampleBank
 
 # PygameとMIDIの初期化
-pygame.mixer.init()
-outport = mido.open_output('IAC Driver My Port1')
-hat_sound = pygame.mixer.Sound('static/audio/hat.wav')
-kick_sound = pygame.mixer.Sound('static/audio/kick.wav')
+mixer_settings = init_mixer()  # バッファを小さくしたミキサー（環境変数で調整できる）
+outport = MidiOutput(mido.open_output('IAC Driver My Port1'))
+drum_bank = SampleBank(DRUM_SAMPLES)  # ドラムごとに専用のチャンネルを予約する
+
+# MIDIポートとミキサーには専用のワーカースレッドだけが触る
+audio_worker = AudioWorker()
+# 鳴らした音は一定時間後に必ずnote_offを送る（期限のnote_offもワーカーで送る）
+active_notes = ActiveNotes(dispatch=audio_worker.submit)
+# 終了時はワーカーを止めてから、残った音をこのスレッドで止める（atexitは登録の逆順）
+atexit.register(drum_bank.stop)
+atexit.register(active_notes.close)
+atexit.register(audio_worker.close)
+
+# 発音とMIDI送信にかかった時間
+probe = LatencyProbe()
+
+# ブラウザへの応答やタイミングの通知（Server-Sent Events）
+events = EventBroadcaster()
 
 app = Flask(__name__)
 
-# 色と音のマッピング
-color_note_map = {
-    "Red": {"note": 60},  # C4
-    "Orange-pink": {"note": 67},  # G4
-    "Yellow": {"note": 62},  # D4
-    "Green": {"note": 69},  # A4
-    "Whitish-blue": {"note": 64},  # E4
-    "Blue, bright": {"note": 66},  # F#4
-    "Violet": {"note": 61},  # Db4
-    "Purplish-violet": {"note": 68},  # Ab4
-    "Steel color with metallic sheen": {"note": 65},  # Eb4
-    "Red, dark": {"note": 63}  # F4
-}
-
-# ドラム専用の色
-drum_color_map = {
-    "White": "hat.wav",
-    "Black": "kick.wav"
-}
+# 1音の長さ（秒）。テンポによらず一定で、/paletteでブラウザにも渡して揃える
+note_duration = 0.25
 
 # フロントエンドのHTMLを提供
 @app.route('/')
 def index():
     return render_template('index.html')
 
-# ノートの再生
+# 色と音の対応表（pypiano/grid_model.py）をブラウザと共有する
+@app.route('/palette')
+def palette():
+    return jsonify({**palette_table(), "note_duration": note_duration})
+
+# ドラムのサンプル（pygameと同じファイル）。DRUM_SAMPLESに載っているファイルだけを返す
+SAMPLE_FILES = {entry["sample"] for entry in DRUM_SAMPLES.values()}
+
+@app.route('/samples/<path:filename>')
+def sample_file(filename):
+    if filename not in SAMPLE_FILES:
+        abort(404)
+    return send_from_directory(SAMPLE_DIR, filename)
+
+# ワーカースレッドで実行する処理
+def emit_note(midi_note):
+    active_notes.note_on(outport, midi_note, 100, duration=note_duration)
+    probe.measure("midi", outport.flush)
+
+def emit_drum(palette_id):
+    probe.measure("mixer", drum_bank.play, palette_id)
+
+def emit_batch(batch_id, notes, drums, scheduled):
+    # 1列分をまとめて鳴らし、MIDIは1回のflushで送る
+    for midi_note in notes:
+        active_notes.note_on(outport, midi_note, 100, duration=note_duration)
+    probe.measure("midi", outport.flush)
+    for palette_id in drums:
+        emit_drum(palette_id)
+    events.publish('ack', {
+        "id": batch_id,
+        "notes": notes,
+        "drums": [PALETTE_NAMES[palette_id] for palette_id in drums],
+        "late_ms": (time.perf_counter() - scheduled) * 1000,
+    })
+
+def parse_event(event):
+    '''{"color": ..., "type": ...} をパレット番号にする。色と種類が合わなければNone'''
+    palette_id = PALETTE_IDS.get(event.get('color'))
+    if palette_id is None or event.get('type') != ('drum' if IS_DRUM[palette_id] else 'note'):
+        return None
+    return palette_id
+
+# ノートの再生（キューに入れてすぐに返す）
 @app.route('/play_note', methods=['POST'])
 def play_note():
-    data = request.json
-    color = data.get('color')
-    note_type = data.get('type')
-
-    if note_type == 'note' and color in color_note_map:
-        midi_note = color_note_map[color]["note"]
-        outport.send(mido.Message('note_on', note=midi_note, velocity=100))
-        return jsonify({"status": "note played", "note": midi_note})
-    elif note_type == 'drum' and color in drum_color_map:
-        sound_file = drum_color_map[color]
-        if sound_file == "hat.wav":
-            hat_sound.play()
-        elif sound_file == "kick.wav":
-            kick_sound.play()
-        return jsonify({"status": "drum sound played", "sound": sound_file})
-
-    return jsonify({"status": "error", "message": "Invalid input"})
+    palette_id = parse_event(request.json)
+    if palette_id is None:
+        return jsonify({"status": "error", "message": "Invalid input"})
+
+    if IS_DRUM[palette_id]:
+        if not audio_worker.submit(emit_drum, palette_id):
+            return jsonify({"status": "error", "message": "Audio queue is full"}), 503
+        return jsonify({"status": "drum sound played", "sound": DRUM_SAMPLES[palette_id]["sample"]})
+
+    midi_note = NOTE_TABLE[palette_id]
+    if not audio_worker.submit(emit_note, midi_note):
+        return jsonify({"status": "error", "message": "Audio queue is full"}), 503
+    return jsonify({"status": "note played", "note": midi_note})
+
+# サーバー側でのパターン再生（行0: ピアノ ch1, 行1: ベース ch2）
+def publish_playhead(column):
+    events.publish('playhead', {"column": column})
+
+player = PatternPlayer(outport, active_notes, audio_worker, emit_drum,
+                       on_step=publish_playhead, row_channels=[0, 1, 0])
+atexit.register(player.stop)
+
+def parse_pattern(data):
+    '''
+    {"grid": [["Red", null, ...], ...], "step_ms": 600} を (GridModel, step_ms) にする。不正ならNone
+    step_msは有限の正の数だけを受け付ける（NaNや無限大ではシーケンサーが動かない）
+    '''
+    if not isinstance(data, dict):
+        return None
+    rows = data.get('grid')
+    step_ms = data.get('step_ms', 600)
+    if not isinstance(rows, list) or not rows or not all(isinstance(row, list) for row in rows):
+        return None
+    if not rows[0] or any(len(row) != len(rows[0]) for row in rows):
+        return None
+    if isinstance(step_ms, bool) or not isinstance(step_ms, (int, float)):
+        return None
+    if not math.isfinite(step_ms) or step_ms <= 0:
+        return None
+    return GridModel.from_names(rows), float(step_ms)
+
+# パターンとテンポを読み込む
+# {"grid": [["Red", null, ...], ...], "step_ms": 600}
+@app.route('/pattern', methods=['POST'])
+def load_pattern():
+    pattern = parse_pattern(request.get_json(silent=True))
+    if pattern is None:
+        return jsonify({"status": "error", "message": "Invalid pattern"}), 400
+    player.load(*pattern)
+    return jsonify({"status": "loaded", **player.state()})
+
+# 保存したパターン（pypianoの再生アプリと同じライブラリ）
+library = PatternLibrary()
+
+@app.route('/patterns')
+def list_patterns():
+    return jsonify(library.list())
+
+# 今のパターンを名前を付けて保存する（本文は /pattern と同じ形）
+@app.route('/patterns/<name>', methods=['POST'])
+def save_pattern(name):
+    pattern = parse_pattern(request.get_json(silent=True))
+    if pattern is None:
+        return jsonify({"status": "error", "message": "Invalid pattern"}), 400
+    try:
+        library.save(name, *pattern)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "saved", "name": name})
+
+@app.route('/patterns/<name>')
+def open_pattern(name):
+    try:
+        grid, step_ms = library.load(name)
+    except FileNotFoundError:
+        return jsonify({"status": "error", "message": "Pattern not found"}), 404
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"name": name, "grid": grid.to_names(), "step_ms": step_ms})
+
+@app.route('/transport/start', methods=['POST'])
+def transport_start():
+    player.start()
+    return jsonify(player.state())
+
+@app.route('/transport/stop', methods=['POST'])
+def transport_stop():
+    player.stop()
+    return jsonify(player.state())
+
+@app.route('/transport/seek', methods=['POST'])
+def transport_seek():
+    data = request.get_json(silent=True)
+    try:
+        column = int(data.get('column', 0))
+    except (AttributeError, TypeError, ValueError, OverflowError):
+        return jsonify({"status": "error", "message": "Invalid column"}), 400
+    player.seek(column)
+    return jsonify(player.state())
+
+@app.route('/transport')
+def transport_state():
+    return jsonify(player.state())
+
+# 1列分やパターン全体をまとめて受け取る
+# {"id": ..., "events": [{"color": ..., "type": ..., "offset_ms": 0}, ...]}
+# offset_msが同じイベントは同じ時刻にまとめて鳴らす
+def reject_batch(func, args):
+    # 予約した時刻にワーカーのキューが一杯で鳴らせなかった列
+    batch_id, notes, drums, scheduled = args
+    events.publish('rejected', {"id": batch_id, "notes": notes,
+                                "drums": [PALETTE_NAMES[palette_id] for palette_id in drums]})
+
+batch_submitter = DelayedSubmitter(audio_worker, on_reject=reject_batch)  # 後の列は1つのスレッドで時刻を待つ
+atexit.register(batch_submitter.close)
+
+def parse_offset(event):
+    '''offset_ms（0以上の数）を返す。不正ならNone'''
+    offset = event.get('offset_ms', 0)
+    if isinstance(offset, bool) or not isinstance(offset, (int, float)) or not 0 <= offset < float('inf'):
+        return None
+    return float(offset)
+
+@app.route('/play_batch', methods=['POST'])
+def play_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('events', []), list):
+        return jsonify({"status": "error", "message": "Invalid batch"}), 400
+    batch_id = data.get('id')
+
+    # 先に全体を確かめてから予約する（途中で400にならないように）
+    groups = {}
+    invalid = []
+    for i, event in enumerate(data.get('events', [])):
+        offset_ms = parse_offset(event) if isinstance(event, dict) else None
+        if offset_ms is None:
+            return jsonify({"status": "error", "message": f"Invalid event {i}"}), 400
+        palette_id = parse_event(event)
+        if palette_id is None:
+            invalid.append(i)
+            continue
+        notes, drums = groups.setdefault(offset_ms, ([], []))
+        if IS_DRUM[palette_id]:
+            drums.append(palette_id)
+        else:
+            notes.append(NOTE_TABLE[palette_id])
+
+    # 受け付けた列と、キューが一杯で受け付けなかった列をそのまま返す
+    now = time.perf_counter()
+    accepted = []
+    rejected = []
+    for offset_ms, (notes, drums) in sorted(groups.items()):
+        scheduled = now + offset_ms / 1000
+        if offset_ms <= 0:
+            ok = audio_worker.submit(emit_batch, batch_id, notes, drums, scheduled)
+        else:
+            ok = batch_submitter.schedule(scheduled, emit_batch, batch_id, notes, drums, scheduled)
+        (accepted if ok else rejected).append(offset_ms)
+
+    if groups and not accepted:
+        return jsonify({"status": "error", "message": "Audio queue is full", "id": batch_id,
+                        "rejected": rejected, "invalid": invalid}), 503
+    return jsonify({"status": "queued" if not rejected else "partial", "id": batch_id, "steps": len(groups),
+                    "accepted": accepted, "rejected": rejected, "invalid": invalid})
+
+# 応答とタイミングを流し続けるイベントチャンネル
+@app.route('/events')
+def event_channel():
+    return Response(events.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+# MIDI出力の送信数
+@app.route('/midi_stats')
+def midi_stats():
+    return jsonify(outport.stats())
+
+# ワーカーのキューの深さと、キューに入れてから送信するまでの遅延
+@app.route('/audio_stats')
+def audio_stats():
+    return jsonify({**audio_worker.stats(), "drums": drum_bank.stats(),
+                    "mixer": mixer_settings, "latency": probe.report()})
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,11 +1,19 @@
 '''GUIでピアノを操作する完成版'''
+import os
+import sys
 import pygame
 import mido
 import time
 
+# pypianoの共通モジュールを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pypiano'))
+from hit_test import HitGrid
+from keyboard_layout import BLACK, WHITE, KeyboardLayout, KeyboardRenderer, wait_events
+from midi_output import MidiOutput
+
 # MIDIの初期化
 def init_midi():
-    outport = mido.open_output('IAC Driver')  # 仮想MIDIデバイスのIDを指定
+    outport = MidiOutput(mido.open_output('IAC Driver'))  # 仮想MIDIデバイスのIDを指定
     return outport
 
 # キーを表すクラス
@@ -20,95 +28,75 @@ class Key:
         self.is_black = is_black
         self.velocity = velocity
 
-    def draw(self, screen):
-        color = self.pressed_color if self.is_pressed else self.base_color
-        pygame.draw.rect(screen, color, self.rect)
-        if not self.is_black:
-            pygame.draw.rect(screen, (0, 0, 0), self.rect, 1)
+    def current_color(self):
+        return self.pressed_color if self.is_pressed else self.base_color
 
     def press(self, midiout):
         if not self.is_pressed:
-            midiout.send(mido.Message('note_on', note=self.note, velocity=self.velocity))
+            midiout.note_on(self.note, self.velocity)
+            midiout.flush()
             self.is_pressed = True
             print(f"Key {self.note} pressed.")
 
     def release(self, midiout):
         if self.is_pressed:
-            midiout.send(mido.Message('note_off', note=self.note, velocity=0))
+            midiout.note_off(self.note, 0)
+            midiout.flush()
             self.is_pressed = False
             print(f"Key {self.note} released.")
 
-# ピアノの鍵盤を設定
+# ピアノの鍵盤を設定（音域を広げれば88鍵 (21, 108) まで並べられる）
+NOTE_RANGE = (60, 71)  # C4からB4
+
 def create_piano_keys():
-    keys = []
-    white_key_notes = [60, 62, 64, 65, 67, 69, 71]  # C4 (60) からの白鍵
-    black_key_notes = [61, 63, 66, 68, 70]  # 黒鍵
-
-    key_width = 40
-    key_height = 200
-    black_key_width = 25
-    black_key_height = 120
-
-    for i, note in enumerate(white_key_notes):
-        rect = pygame.Rect(i * key_width, 0, key_width, key_height)
-        key = Key(note, rect, (255, 255, 255), is_black=False)
-        keys.append(key)
-
-    black_key_positions = {
-        61: key_width - black_key_width // 2,
-        63: 2 * key_width - black_key_width // 2,
-        66: 4 * key_width - black_key_width // 2,
-        68: 5 * key_width - black_key_width // 2,
-        70: 6 * key_width - black_key_width // 2
-    }
-
-    for note in black_key_notes:
-        x = black_key_positions[note]
-        rect = pygame.Rect(x, 0, black_key_width, black_key_height)
-        key = Key(note, rect, (0, 0, 0), is_black=True)
-        keys.append(key)
-
-    keys.sort(key=lambda k: k.is_black)  # 黒鍵を先に描画
-    return keys
+    layout = KeyboardLayout([(NOTE_RANGE[0], NOTE_RANGE[1], 0)])
+    keys = [Key(note, rect, BLACK if black else WHITE, is_black=bool(black))
+            for rect, note, black in zip(layout.rects, layout.notes, layout.black)]
+    return layout, keys
+
+# 入力を待つ最長時間（ms）。何も起きなければこの間隔でしか起きない
+IDLE_TIMEOUT = 1000
 
 # メインのGUI関数
 def piano_gui():
     pygame.init()
-    screen = pygame.display.set_mode((7 * 40, 200))
+    layout, keys = create_piano_keys()
+    screen = pygame.display.set_mode((layout.width, layout.height))
     pygame.display.set_caption("MIDI Piano")
+    renderer = KeyboardRenderer(layout)  # 鍵盤は1枚のSurfaceに描いておく
 
     midiout = init_midi()
-    keys = create_piano_keys()
+    hits = HitGrid.from_items(layout.items())  # 座標から鍵盤の番号を引く索引（黒鍵が手前）
     running = True
-    clock = pygame.time.Clock()
+    pygame.event.set_blocked(pygame.MOUSEMOTION)  # ドラッグは使わないので、マウスを動かしただけでは起きない
 
     while running:
-        screen.fill((255, 255, 255))
-
-        for event in pygame.event.get():
+        changed = []  # 押したり離したりした鍵盤
+        for event in wait_events(IDLE_TIMEOUT):
             if event.type == pygame.QUIT:
                 running = False
 
+            elif event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE):
+                renderer.invalidate()
+
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
-                    mouse_pos = event.pos
-                    for key in reversed(keys):
-                        if key.rect.collidepoint(mouse_pos):
-                            key.press(midiout)
-                            break
+                    i = hits.find(event.pos)
+                    if i is not None:
+                        keys[i].press(midiout)
+                        changed.append(i)
 
             elif event.type == pygame.MOUSEBUTTONUP:
                 if event.button == 1:
-                    mouse_pos = event.pos
-                    for key in keys:
-                        if key.is_pressed and key.rect.collidepoint(mouse_pos):
-                            key.release(midiout)
-
-        for key in keys:
-            key.draw(screen)
-
-        pygame.display.update()
-        clock.tick(60)
+                    i = hits.find(event.pos)
+                    if i is not None and keys[i].is_pressed:
+                        keys[i].release(midiout)
+                        changed.append(i)
+
+        # 状態が変わった鍵盤だけを描き直して、その範囲だけ画面に反映する
+        for i in changed:
+            renderer.set_color(i, keys[i].current_color())
+        renderer.present(screen)
 
     midiout.close()
     pygame.quit()
@@ -1,11 +1,19 @@
 '''GUIでピアノとベースを操作するピアノとベース試す'''
+import os
+import sys
 import pygame
 import mido
 import time
 
+# pypianoの共通モジュールを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pypiano'))
+from hit_test import HitGrid
+from keyboard_layout import BLACK, WHITE, KeyboardLayout, KeyboardRenderer, wait_events
+from midi_output import MidiOutput
+
 # MIDIの初期化
 def init_midi():
-    outport = mido.open_output('IAC Driver My Port1')  # 正しい仮想MIDIデバイス名を指定
+    outport = MidiOutput(mido.open_output('IAC Driver My Port1'))  # 正しい仮想MIDIデバイス名を指定
     return outport
 
 # キーを表すクラス
@@ -21,105 +29,78 @@ class Key:
         self.velocity = velocity
         self.channel = channel  # チャンネルを追加
 
-    def draw(self, screen):
-        color = self.pressed_color if self.is_pressed else self.base_color
-        pygame.draw.rect(screen, color, self.rect)
-        if not self.is_black:
-            pygame.draw.rect(screen, (0, 0, 0), self.rect, 1)
+    def current_color(self):
+        return self.pressed_color if self.is_pressed else self.base_color
 
     def press(self, midiout):
         if not self.is_pressed:
-            midiout.send(mido.Message('note_on', note=self.note, velocity=self.velocity, channel=self.channel))
+            midiout.note_on(self.note, self.velocity, self.channel)
+            midiout.flush()
             self.is_pressed = True
             print(f"Key {self.note} pressed on channel {self.channel}.")
 
     def release(self, midiout):
         if self.is_pressed:
-            midiout.send(mido.Message('note_off', note=self.note, velocity=0, channel=self.channel))
+            midiout.note_off(self.note, 0, self.channel)
+            midiout.flush()
             self.is_pressed = False
             print(f"Key {self.note} released on channel {self.channel}.")
 
-# ピアノとベースの鍵盤を設定
+# ピアノとベースの鍵盤を設定（段ごとに音域とチャンネルを指定する）
+MANUALS = [
+    (60, 71, 1),  # ピアノ: C4からB4、チャンネル1
+    (36, 47, 2, True),  # ベース: C2からB2の白鍵だけ、チャンネル2
+]
+
 def create_instrument_keys():
-    keys = []
-
-    # ピアノ（MIDIチャンネル1）
-    white_key_notes = [60, 62, 64, 65, 67, 69, 71]  # C4 (60) からの白鍵
-    black_key_notes = [61, 63, 66, 68, 70]  # 黒鍵
-
-    key_width = 40
-    key_height = 200
-    black_key_width = 25
-    black_key_height = 120
-
-    for i, note in enumerate(white_key_notes):
-        rect = pygame.Rect(i * key_width, 0, key_width, key_height)
-        key = Key(note, rect, (255, 255, 255), is_black=False, channel=1)  # チャンネル1はピアノ
-        keys.append(key)
-
-    black_key_positions = {
-        61: key_width - black_key_width // 2,
-        63: 2 * key_width - black_key_width // 2,
-        66: 4 * key_width - black_key_width // 2,
-        68: 5 * key_width - black_key_width // 2,
-        70: 6 * key_width - black_key_width // 2
-    }
-
-    for note in black_key_notes:
-        x = black_key_positions[note]
-        rect = pygame.Rect(x, 0, black_key_width, black_key_height)
-        key = Key(note, rect, (0, 0, 0), is_black=True, channel=1)  # ピアノの黒鍵もチャンネル1
-        keys.append(key)
-
-    # ベース（MIDIチャンネル2）
-    bass_notes = [36, 38, 40, 41, 43, 45, 47]  # C2 (36) からの白鍵
-
-    for i, note in enumerate(bass_notes):
-        rect = pygame.Rect(i * key_width, key_height + 10, key_width, key_height)
-        key = Key(note, rect, (255, 255, 255), is_black=False, channel=2)  # チャンネル2はベース
-        keys.append(key)
-
-    keys.sort(key=lambda k: (k.is_black, k.channel))  # 黒鍵を先に描画、次にチャンネルでソート
-    return keys
+    layout = KeyboardLayout(MANUALS)
+    keys = [Key(note, rect, BLACK if black else WHITE, is_black=bool(black), channel=channel)
+            for rect, note, channel, black in zip(layout.rects, layout.notes, layout.channels, layout.black)]
+    return layout, keys
+
+# 入力を待つ最長時間（ms）。何も起きなければこの間隔でしか起きない
+IDLE_TIMEOUT = 1000
 
 # メインのGUI関数
 def piano_bass_gui():
     pygame.init()
-    screen = pygame.display.set_mode((7 * 40, 420))  # 画面を広くしてベースの鍵盤を追加
+    layout, keys = create_instrument_keys()
+    screen = pygame.display.set_mode((layout.width, layout.height))  # 段の数に合わせた大きさ
     pygame.display.set_caption("MIDI Piano and Bass")
+    renderer = KeyboardRenderer(layout)  # 鍵盤は1枚のSurfaceに描いておく
 
     midiout = init_midi()
-    keys = create_instrument_keys()
+    hits = HitGrid.from_items(layout.items())  # 座標から鍵盤の番号を引く索引（黒鍵が手前）
     running = True
-    clock = pygame.time.Clock()
+    pygame.event.set_blocked(pygame.MOUSEMOTION)  # ドラッグは使わないので、マウスを動かしただけでは起きない
 
     while running:
-        screen.fill((255, 255, 255))
-
-        for event in pygame.event.get():
+        changed = []  # 押したり離したりした鍵盤
+        for event in wait_events(IDLE_TIMEOUT):
             if event.type == pygame.QUIT:
                 running = False
 
+            elif event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE):
+                renderer.invalidate()
+
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
-                    mouse_pos = event.pos
-                    for key in reversed(keys):
-                        if key.rect.collidepoint(mouse_pos):
-                            key.press(midiout)
-                            break
+                    i = hits.find(event.pos)
+                    if i is not None:
+                        keys[i].press(midiout)
+                        changed.append(i)
 
             elif event.type == pygame.MOUSEBUTTONUP:
                 if event.button == 1:
-                    mouse_pos = event.pos
-                    for key in keys:
-                        if key.is_pressed and key.rect.collidepoint(mouse_pos):
-                            key.release(midiout)
-
-        for key in keys:
-            key.draw(screen)
-
-        pygame.display.update()
-        clock.tick(60)
+                    i = hits.find(event.pos)
+                    if i is not None and keys[i].is_pressed:
+                        keys[i].release(midiout)
+                        changed.append(i)
+
+        # 状態が変わった鍵盤だけを描き直して、その範囲だけ画面に反映する
+        for i in changed:
+            renderer.set_color(i, keys[i].current_color())
+        renderer.present(screen)
 
     midiout.close()
     pygame.quit()
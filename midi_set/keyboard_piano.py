@@ -1,14 +1,34 @@
 # キーボードの音をGUI操作で鳴らすが最初の一音目しか鳴らないバグがある
+import os
+import sys
 import pygame
 import pygame.midi
+import heapq
 import time
 
+# pypianoの共通モジュールを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pypiano'))
+from hit_test import HitGrid
+from keyboard_layout import BLACK, WHITE, KeyboardLayout, KeyboardRenderer, wait_events
+
 '''MIDIの初期化'''
 def init_midi():
     pygame.midi.init()
     output_id = pygame.midi.get_default_output_id() # 仮想MIDIデバイスのIDに置き換えてください
     return pygame.midi.Output(output_id)
 
+FADE_STEPS = 30  # フェードの色の段階数
+
+_fade_cache = {}
+
+def fade_colors(start, end, steps=FADE_STEPS):
+    '''startからendまでの色の段階を一度だけ計算して使い回す'''
+    ramp = _fade_cache.get((start, end, steps))
+    if ramp is None:
+        ramp = [tuple(int(a + (b - a) * step / steps) for a, b in zip(start, end)) for step in range(steps + 1)]
+        _fade_cache[(start, end, steps)] = ramp
+    return ramp
+
 # キーを表すクラス
 class Key:
     def __init__(self, note, rect, color, is_black, velocity=100):
@@ -26,137 +46,165 @@ class Key:
         self.color = color
         self.base_color = color
         self.pressed_color = (200, 200, 200) if not is_black else (50, 50, 50)
+        self.fade = fade_colors(self.pressed_color, self.base_color)
         self.is_pressed = False
         self.is_black = is_black
         self.velocity = velocity
         self.release_time = None
         self.release_duration = 0.5  # 0.5秒でフェードアウト
 
-    def draw(self, screen):
+    def current_color(self, now):
         if self.is_pressed:
-            color = self.pressed_color
+            return self.pressed_color
         elif self.release_time is not None:
-            t = min(1, (time.time() - self.release_time) / self.release_duration)
-            r = int(self.pressed_color[0] + (self.base_color[0] - self.pressed_color[0]) * t)
-            g = int(self.pressed_color[1] + (self.base_color[1] - self.pressed_color[1]) * t)
-            b = int(self.pressed_color[2] + (self.base_color[2] - self.pressed_color[2]) * t)
-            color = (r, g, b)
-        else:
-            color = self.base_color
-
-        pygame.draw.rect(screen, color, self.rect) # 矩形を描画
-        if not self.is_black:
-            pygame.draw.rect(screen, (0, 0, 0), self.rect, 1) # 矩形の枠を描画
+            step = int((now - self.release_time) / self.release_duration * FADE_STEPS)
+            return self.fade[min(step, FADE_STEPS)]
+        return self.base_color
 
     def press(self, midiout):
         if not self.is_pressed:
+            if self.release_time is not None:
+                midiout.write_short(0x80, self.note, 0)  # フェード中の音を止めてから鳴らし直す
             midiout.write_short(0x90, self.note, self.velocity) # ノートオン
             self.is_pressed = True
             self.release_time = None
             print(f"Key {self.note} pressed.")
 
-    def release(self, midiout):
+    def release(self, now):
+        '''離したらフェードを始める。ノートオフはフェードが終わったときにfinishで送る'''
         if self.is_pressed:
-            midiout.write_short(0x80, self.note, 0) # ノートオフ
             self.is_pressed = False
-            self.release_time = time.time()
+            self.release_time = now
             print(f"Key {self.note} released.")
+            return now + self.release_duration
+        return None
 
-    def update(self, midiout):
-        if not self.is_pressed and self.release_time is not None:
-            t = (time.time() - self.release_time) / self.release_duration
-            if t >= 1:
-                midiout.write_short(0x80, self.note, 0)
-                self.release_time = None
-                print(f"Key {self.note} fade-out completed.")
+    def finish(self, midiout):
+        if self.release_time is not None:
+            midiout.write_short(0x80, self.note, 0) # ノートオフ
+            self.release_time = None
+            print(f"Key {self.note} fade-out completed.")
+
+
+class ReleaseScheduler:
+    '''
+    フェードアウト中の鍵盤を、終わる時刻のヒープで管理する
+    毎フレームの処理はフェード中の鍵盤の数だけで、鍵盤の総数によらない
+    '''
+    def __init__(self):
+        self._heap = []  # (終わる時刻, 通し番号, 鍵盤の番号)
+        self.pending = {}  # 鍵盤の番号 -> 通し番号（取り消されたものはヒープに残っても無視する）
+        self._counter = 0
+
+    def schedule(self, index, deadline):
+        self._counter += 1
+        self.pending[index] = self._counter
+        heapq.heappush(self._heap, (deadline, self._counter, index))
+
+    def cancel(self, index):
+        self.pending.pop(index, None)
+
+    def pop_due(self, now):
+        '''終わる時刻を過ぎた鍵盤の番号を返す'''
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, counter, index = heapq.heappop(self._heap)
+            if self.pending.get(index) == counter:
+                del self.pending[index]
+                due.append(index)
+        return due
+
+# ピアノの鍵盤を設定（音域を広げれば88鍵 (21, 108) まで並べられる）
+NOTE_RANGE = (60, 71)
 
-# ピアノの鍵盤を設定
 def create_piano_keys():
-    keys = []
-    white_key_notes = [60, 62, 64, 65, 67, 69, 71]
-    black_key_notes = [61, 63, 66, 68, 70]
-
-    key_width = 40
-    key_height = 200
-    black_key_width = 25
-    black_key_height = 120
-
-    for i, note in enumerate(white_key_notes):
-        rect = pygame.Rect(i * key_width, 0, key_width, key_height)
-        key = Key(note, rect, (255, 255, 255), is_black=False)
-        keys.append(key)
-
-    black_key_positions = {
-        61: key_width - black_key_width // 2,
-        63: 2 * key_width - black_key_width // 2,
-        66: 4 * key_width - black_key_width // 2,
-        68: 5 * key_width - black_key_width // 2,
-        70: 6 * key_width - black_key_width // 2
-    }
-
-    for note in black_key_notes:
-        x = black_key_positions[note]
-        rect = pygame.Rect(x, 0, black_key_width, black_key_height)
-        key = Key(note, rect, (0, 0, 0), is_black=True)
-        keys.append(key)
-
-    keys.sort(key=lambda k: k.is_black)
-    return keys
+    layout = KeyboardLayout([(NOTE_RANGE[0], NOTE_RANGE[1], 0)])
+    keys = [Key(note, rect, BLACK if black else WHITE, is_black=bool(black))
+            for rect, note, black in zip(layout.rects, layout.notes, layout.black)]
+    return layout, keys
+
+# 入力を待つ最長時間（ms）。フェード中は約60FPSで起き、何もしていなければほとんど眠る
+FRAME_TIMEOUT = 16
+IDLE_TIMEOUT = 1000
 
 # メインのGUI関数
 def piano_gui():
     pygame.init()
-    screen = pygame.display.set_mode((7 * 40, 200))
+    layout, keys = create_piano_keys()
+    screen = pygame.display.set_mode((layout.width, layout.height))
     pygame.display.set_caption("MIDI Piano")
+    renderer = KeyboardRenderer(layout)  # 鍵盤は1枚のSurfaceに描いておく
 
     midiout = init_midi()
-    keys = create_piano_keys()
-    running = True
+    hits = HitGrid.from_items(layout.items())  # 座標から鍵盤の番号を引く索引（黒鍵が手前）
+    dragged = None  # ドラッグ中に押している鍵盤の番号
+    releases = ReleaseScheduler()  # フェードアウト中の鍵盤
 
-    clock = pygame.time.Clock()
+    def press(i):
+        releases.cancel(i)
+        keys[i].press(midiout)
 
-    while running:
-        screen.fill((255, 255, 255))
+    def release(i):
+        deadline = keys[i].release(time.perf_counter())
+        if deadline is not None:
+            releases.schedule(i, deadline)
 
-        for event in pygame.event.get():
+    running = True
+
+    while running:
+        # フェード中だけ一定間隔で起き、それ以外は入力が来るまで眠る
+        changed = []
+        for event in wait_events(FRAME_TIMEOUT if releases.pending else IDLE_TIMEOUT):
             if event.type == pygame.QUIT:
                 running = False
 
+            elif event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE):
+                renderer.invalidate()
+
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
-                    mouse_pos = event.pos
-                    for key in reversed(keys):
-                        if key.rect.collidepoint(mouse_pos):
-                            key.press(midiout)
-                            break
+                    i = hits.find(event.pos)
+                    if i is not None:
+                        press(i)
+                        changed.append(i)
+                    dragged = i
 
             elif event.type == pygame.MOUSEBUTTONUP:
                 if event.button == 1:
-                    mouse_pos = event.pos
-                    for key in keys:
-                        if key.is_pressed and key.rect.collidepoint(mouse_pos):
-                            key.release(midiout)
+                    i = hits.find(event.pos)
+                    if i is not None and keys[i].is_pressed:
+                        release(i)
+                        changed.append(i)
+                    dragged = None
 
             elif event.type == pygame.MOUSEMOTION:
                 if event.buttons[0]:  # Left mouse button is held down
-                    mouse_pos = event.pos
-                    for key in reversed(keys):
-                        if key.rect.collidepoint(mouse_pos):
-                            if not key.is_pressed:
-                                key.press(midiout)
-                        elif key.is_pressed:
-                            key.release(midiout)
-
-        for key in keys:
-            key.update(midiout)
-            key.draw(screen)
-
-        pygame.display.update()
-        clock.tick(60)  # Limit the frame rate to 60 FPS
-
-    # すべての音を停止
+                    # 別の鍵盤に移ったときだけ、前の鍵盤を離して新しい鍵盤を押す
+                    i = hits.find(event.pos)
+                    if i != dragged:
+                        if dragged is not None and keys[dragged].is_pressed:
+                            release(dragged)
+                            changed.append(dragged)
+                        if i is not None and not keys[i].is_pressed:
+                            press(i)
+                            changed.append(i)
+                        dragged = i
+
+        # フェードが終わった鍵盤だけノートオフを送り、フェード中の鍵盤だけ色を進める
+        now = time.perf_counter()
+        for i in releases.pop_due(now):
+            keys[i].finish(midiout)
+            changed.append(i)
+        for i in changed:
+            renderer.set_color(i, keys[i].current_color(now))
+        for i in releases.pending:
+            renderer.set_color(i, keys[i].current_color(now))
+        renderer.present(screen)
+
+    # 鳴っている音とフェード中の音を停止
     for key in keys:
-        midiout.write_short(0x80, key.note, 0)
+        if key.is_pressed or key.release_time is not None:
+            midiout.write_short(0x80, key.note, 0)
 
     midiout.close()
     pygame.midi.quit()
@@ -0,0 +1,114 @@
+'''パソコンのキーボードと外部MIDI入力でピアノを弾くライブ演奏モード
+
+使い方:
+    python live_piano.py [MIDI入力のポート名]
+A W S E D F T G Y H U J K O L P ; で C4 から E5 まで弾ける。マウスでも弾ける
+音は入力用のスレッドがすぐに送り、画面は送ったあとに状態を映すだけ
+終了すると、入力の種類ごとに入力から送信までの遅延のヒストグラムを表示する
+'''
+import os
+import sys
+import pygame
+import mido
+
+# pypianoの共通モジュールを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pypiano'))
+from hit_test import HitGrid
+from keyboard_layout import KeyboardLayout, KeyboardRenderer, wait_events
+from live_input import QWERTY_LAYOUT, LiveInput
+from midi_output import MidiOutput
+
+# MIDIの初期化
+def init_midi():
+    outport = MidiOutput(mido.open_output('IAC Driver'))  # 仮想MIDIデバイスのIDを指定
+    return outport
+
+# ピアノの鍵盤を設定（QWERTYで弾ける C4 から E5 まで）
+NOTE_RANGE = (60, 76)
+BASE_NOTE = 60
+PRESSED_WHITE = (200, 200, 200)
+PRESSED_BLACK = (50, 50, 50)
+
+# 入力を待つ最長時間（ms）。入力スレッドからの通知でもすぐに起きる
+IDLE_TIMEOUT = 1000
+
+# 入力スレッドが送ったことをGUIに知らせるイベント
+LIVE_NOTE = pygame.event.custom_type()
+
+def post_change(channel, note, is_on):
+    pygame.event.post(pygame.event.Event(LIVE_NOTE, channel=channel, note=note, on=is_on))
+
+def print_latency(live):
+    for source, bins in live.probe.histogram().items():
+        print(f"{source}:")
+        total = sum(count for _, count in bins) or 1
+        for label, count in bins:
+            print(f"  {label:>8} {count:6d} {'#' * round(count / total * 40)}")
+    for source, values in live.probe.report().items():
+        print(f"{source}: p50={values['p50_ms']:.3f} ms, p95={values['p95_ms']:.3f} ms, max={values['max_ms']:.3f} ms")
+
+# メインのGUI関数
+def piano_gui(midi_input=None):
+    pygame.init()
+    layout = KeyboardLayout([(NOTE_RANGE[0], NOTE_RANGE[1], 0)])
+    screen = pygame.display.set_mode((layout.width, layout.height))
+    pygame.display.set_caption("Live Piano")
+    renderer = KeyboardRenderer(layout)  # 鍵盤は1枚のSurfaceに描いておく
+    hits = HitGrid.from_items(layout.items())  # 座標から鍵盤の番号を引く索引（黒鍵が手前）
+    pygame.event.set_blocked(pygame.MOUSEMOTION)
+
+    live = LiveInput(init_midi(), on_change=post_change)
+    if midi_input is not None:
+        live.open_midi_input(midi_input)
+        print(f"MIDI input: {midi_input}")
+    clicked = None  # マウスで押している鍵盤のノート
+    running = True
+
+    while running:
+        for event in wait_events(IDLE_TIMEOUT):
+            if event.type == pygame.QUIT:
+                running = False
+
+            elif event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE):
+                renderer.invalidate()
+
+            # 入力は時刻を付けて入力スレッドに渡すだけ。鍵盤の色は送ったあとのLIVE_NOTEで変える
+            elif event.type in (pygame.KEYDOWN, pygame.KEYUP):
+                offset = QWERTY_LAYOUT.get(pygame.key.name(event.key))
+                if offset is not None:
+                    if event.type == pygame.KEYDOWN:
+                        live.press(BASE_NOTE + offset)
+                    else:
+                        live.release(BASE_NOTE + offset)
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                    running = False
+
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                if event.button == 1:
+                    i = hits.find(event.pos)
+                    if i is not None:
+                        clicked = layout.notes[i]
+                        live.press(clicked, source="mouse")
+
+            elif event.type == pygame.MOUSEBUTTONUP:
+                if event.button == 1 and clicked is not None:
+                    live.release(clicked, source="mouse")
+                    clicked = None
+
+            elif event.type == LIVE_NOTE:
+                i = layout.index.get((0, event.note))
+                if i is not None:
+                    if event.on:
+                        renderer.set_color(i, PRESSED_BLACK if layout.black[i] else PRESSED_WHITE)
+                    else:
+                        renderer.reset_color(i)
+
+        renderer.present(screen)
+
+    live.close()
+    live.output.close()
+    pygame.quit()
+    print_latency(live)
+
+if __name__ == "__main__":
+    piano_gui(sys.argv[1] if len(sys.argv) > 1 else None)
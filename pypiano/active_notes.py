@@ -0,0 +1,112 @@
+'''鳴っている音を管理し、必ずnote_offを送るための登録簿'''
+import heapq
+import threading
+import time
+
+
+class ActiveNotes:
+    '''
+    (出力, チャンネル, ノート) ごとに鳴っている音を記録する
+    出力はMidiOutputで、note_on/note_offはすべてここを通して送る
+    durationを指定した音は、バックグラウンドのスレッドが期限に自動でnote_offを送る
+    dispatch: 期限が来たnote_offを送る処理を渡す関数 dispatch(func, *args)（AudioWorker.submitなど）
+              指定するとバックグラウンドのスレッドはポートに触らず、送信はdispatch先のスレッドだけで行う
+              Falseを返したら少し後にもう一度渡す
+    '''
+    retry_delay = 0.005  # dispatchに断られたときに渡し直すまでの時間（秒）
+
+    def __init__(self, dispatch=None):
+        self.dispatch = dispatch
+        self._notes = {}  # (output, channel, note) -> 自動で止める時刻（なければNone）
+        self._releases = []  # (時刻, 通し番号, key, 止める時刻) のヒープ
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def note_on(self, output, note, velocity=100, channel=0, duration=None):
+        key = (output, channel, note)
+        with self._condition:
+            if key in self._notes:
+                # 鳴っている音を鳴らし直すときは先に止める
+                output.note_off(note, 0, channel)
+            output.note_on(note, velocity, channel)
+            deadline = None
+            if duration is not None:
+                deadline = time.perf_counter() + duration
+                self._counter += 1
+                heapq.heappush(self._releases, (deadline, self._counter, key, deadline))
+                self._condition.notify()
+            self._notes[key] = deadline
+
+    def note_off(self, output, note, channel=0):
+        '''鳴っている音だけを止める。鳴っていなければ何も送らない'''
+        key = (output, channel, note)
+        with self._condition:
+            if self._notes.pop(key, False) is False:
+                return False
+            output.note_off(note, 0, channel)
+            return True
+
+    def release_all(self, output=None, all_notes_off=True, keep=()):
+        '''
+        鳴っている音をすべて止める（停止・クリア・終了時）
+        output: 指定した出力の音だけを止める（Noneならすべて）
+        all_notes_off: 使ったチャンネルにAll Notes Offも送る
+        keep: 止めずに残す (チャンネル, ノート)
+        '''
+        with self._condition:
+            keys = [key for key in self._notes
+                    if (output is None or key[0] is output) and key[1:] not in keep]
+            channels = set()
+            for key in keys:
+                out, channel, note = key
+                del self._notes[key]
+                out.note_off(note, 0, channel)
+                channels.add((out, channel))
+            for out in {out for out, _ in channels}:
+                out.flush()
+            if all_notes_off:
+                for out, channel in channels:
+                    out.all_notes_off(channel)
+            return len(keys)
+
+    def close(self):
+        '''すべての音を止めて、自動リリースのスレッドを終了する'''
+        self.release_all()
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        with self._condition:
+            while self._running:
+                if not self._releases:
+                    self._condition.wait()
+                    continue
+                due, _, key, deadline = self._releases[0]
+                remaining = due - time.perf_counter()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                heapq.heappop(self._releases)
+                # 鳴らし直しや手動のnote_offで期限が変わっていれば古い予定は無視する
+                if self._notes.get(key) != deadline:
+                    continue
+                if self.dispatch is None:
+                    self._expire(key, deadline)
+                elif self.dispatch(self._expire, key, deadline) is False:
+                    self._counter += 1
+                    heapq.heappush(self._releases,
+                                   (time.perf_counter() + self.retry_delay, self._counter, key, deadline))
+
+    def _expire(self, key, deadline):
+        with self._condition:
+            if self._notes.get(key) != deadline:
+                return
+            del self._notes[key]
+            output, channel, note = key
+            output.note_off(note, 0, channel)
+            output.flush()
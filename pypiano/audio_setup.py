@@ -0,0 +1,186 @@
+'''ミキサーの設定と、ドラム（ミキサー）とMIDIの経路の遅延を測るプローブ
+
+使い方:
+    python audio_setup.py [--buffer 256] [--frequency 44100] [--midi-out ポート名] [--midi-in ポート名]
+--midi-inにmidi-outの折り返し（IACのループバックなど）を指定すると、MIDIの往復時間も測る
+'''
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import pygame
+
+# 既定のミキサー設定。マシンごとに環境変数 PYPIANO_MIXER_BUFFER などで上書きできる
+MIXER_CONFIG = {
+    "frequency": 44100,
+    "size": -16,
+    "channels": 2,
+    "buffer": 256,  # pygameの既定(512)より小さくして、ドラムの発音までの待ちを減らす
+}
+
+# 遅延のヒストグラムの区切り（ms）。最後の区切りより大きいものは最後のビンに入る
+HISTOGRAM_EDGES_MS = (0.25, 0.5, 1, 2, 4, 8, 16)
+
+
+def mixer_config(**overrides):
+    '''既定値 < 環境変数 < 引数 の順に設定をまとめる'''
+    config = dict(MIXER_CONFIG)
+    for key in config:
+        value = os.environ.get(f"PYPIANO_MIXER_{key.upper()}")
+        if value is not None:
+            config[key] = int(value)
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    return config
+
+
+def init_mixer(**overrides):
+    '''
+    設定したバッファサイズでミキサーを初期化し直す
+    pygame.init()が既定の設定でミキサーを開いていても作り直す
+    実際の設定と、バッファ1つ分の長さ(buffer_ms)を返す
+    '''
+    config = mixer_config(**overrides)
+    if pygame.mixer.get_init():
+        pygame.mixer.quit()
+    pygame.mixer.init(frequency=config["frequency"], size=config["size"],
+                      channels=config["channels"], buffer=config["buffer"])
+    frequency, size, channels = pygame.mixer.get_init()
+    return {
+        "frequency": frequency,
+        "size": size,
+        "channels": channels,
+        "buffer": config["buffer"],
+        "buffer_ms": config["buffer"] / frequency * 1000,
+    }
+
+
+class LatencyProbe:
+    '''
+    経路ごと（"mixer", "midi" など）に遅延を記録して集計する
+    history: 経路ごとに保持する件数
+    別のスレッドから記録しながら集計してもよい
+    '''
+    def __init__(self, history=1024):
+        self.history = history
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, path, seconds):
+        with self._lock:
+            self.samples.setdefault(path, deque(maxlen=self.history)).append(seconds)
+
+    def _snapshot(self):
+        with self._lock:
+            return {path: list(samples) for path, samples in self.samples.items()}
+
+    def measure(self, path, func, *args):
+        '''funcの呼び出しにかかった時間を記録して、funcの戻り値を返す'''
+        start = time.perf_counter()
+        result = func(*args)
+        self.record(path, time.perf_counter() - start)
+        return result
+
+    def report(self):
+        result = {}
+        for path, samples in self._snapshot().items():
+            values = sorted(sample * 1000 for sample in samples)
+            if not values:
+                continue
+            result[path] = {
+                "count": len(values),
+                "mean_ms": sum(values) / len(values),
+                "p50_ms": values[len(values) // 2],
+                "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+                "max_ms": values[-1],
+            }
+        return result
+
+    def histogram(self, edges=HISTOGRAM_EDGES_MS):
+        '''
+        経路ごとに、遅延がedgesのどの区間に入ったかを数える
+        {経路: [("<0.25ms", 件数), ..., (">16ms", 件数)]}
+        '''
+        labels = [f"<{edge}ms" for edge in edges] + [f">{edges[-1]}ms"]
+        result = {}
+        for path, samples in self._snapshot().items():
+            counts = [0] * len(labels)
+            for sample in samples:
+                ms = sample * 1000
+                for i, edge in enumerate(edges):
+                    if ms < edge:
+                        counts[i] += 1
+                        break
+                else:
+                    counts[-1] += 1
+            result[path] = list(zip(labels, counts))
+        return result
+
+
+def probe_mixer(probe, bank, name, count=200, interval=0.01):
+    '''ドラムを鳴らす呼び出しの時間を測る'''
+    for _ in range(count):
+        probe.measure("mixer_trigger", bank.play, name)
+        time.sleep(interval)
+
+
+def probe_midi(probe, outport, inport=None, count=200, interval=0.01, timeout=0.5):
+    '''
+    MIDIの送信にかかる時間を測る
+    inportがあれば、送ったnote_onが戻ってくるまでの往復時間も測る
+    '''
+    import mido
+    for i in range(count):
+        note = 36 + i % 48
+        message = mido.Message('note_on', note=note, velocity=1)
+        start = time.perf_counter()
+        outport.send(message)
+        probe.record("midi_send", time.perf_counter() - start)
+        if inport is not None:
+            deadline = start + timeout
+            while time.perf_counter() < deadline:
+                received = inport.poll()
+                if received is not None and received.type == 'note_on' and received.note == note:
+                    probe.record("midi_roundtrip", time.perf_counter() - start)
+                    break
+        outport.send(mido.Message('note_off', note=note))
+        time.sleep(interval)
+
+
+def parse_args(argv):
+    options = {}
+    for i, arg in enumerate(argv):
+        if arg.startswith('--') and i + 1 < len(argv):
+            options[arg[2:]] = argv[i + 1]
+    return options
+
+
+if __name__ == '__main__':
+    from grid_model import DRUM_SAMPLES
+    from sample_bank import SampleBank
+
+    options = parse_args(sys.argv[1:])
+    pygame.init()
+    config = init_mixer(buffer=int(options["buffer"]) if "buffer" in options else None,
+                        frequency=int(options["frequency"]) if "frequency" in options else None)
+    print("Mixer:", config)
+
+    probe = LatencyProbe()
+    bank = SampleBank(DRUM_SAMPLES)
+    probe_mixer(probe, bank, next(iter(DRUM_SAMPLES)))
+
+    if "midi-out" in options:
+        import mido
+        outport = mido.open_output(options["midi-out"])
+        inport = mido.open_input(options["midi-in"]) if "midi-in" in options else None
+        probe_midi(probe, outport, inport)
+        outport.close()
+        if inport is not None:
+            inport.close()
+
+    for path, values in probe.report().items():
+        print(f"{path}: " + ", ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                                      for key, value in values.items()))
+    # ミキサーはトリガーの呼び出しに加えて、最大でバッファ1つ分遅れて出力される
+    print(f"mixer output buffer: {config['buffer_ms']:.2f} ms")
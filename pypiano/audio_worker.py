@@ -0,0 +1,115 @@
+'''MIDI送信と効果音の再生を1つのスレッドにまとめるワーカー'''
+import heapq
+import queue
+import threading
+import time
+from collections import deque
+
+
+class AudioWorker:
+    '''
+    submitした処理を専用スレッドで順番に実行する
+    ポートやミキサーに触るのはこのスレッドだけになり、呼び出し側はすぐに戻れる
+    maxsize: キューに溜められる最大数
+    history: 遅延を保持する件数
+    '''
+    def __init__(self, maxsize=1024, history=1024):
+        self._queue = queue.Queue(maxsize)
+        self.latencies = deque(maxlen=history)  # キューに入れてから実行し終わるまでの時間（秒）
+        self.processed = 0
+        self.rejected = 0  # キューが一杯で受け付けなかった数
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args):
+        '''処理をキューに入れる。一杯ならFalseを返す'''
+        try:
+            self._queue.put_nowait((time.perf_counter(), func, args))
+            return True
+        except queue.Full:
+            self.rejected += 1
+            return False
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        latencies = [latency * 1000 for latency in self.latencies]
+        return {
+            "queue_depth": self.queue_depth(),
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "latency_mean_ms": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_max_ms": max(latencies) if latencies else 0.0,
+        }
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            enqueued, func, args = item
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Audio worker error: {e}")
+            self.latencies.append(time.perf_counter() - enqueued)
+            self.processed += 1
+
+
+class DelayedSubmitter:
+    '''
+    時刻を指定した処理を1つのスレッドで待ち、時刻になったらworkerにsubmitする
+    処理ごとにTimerのスレッドを作らないので、パターン全体を予約しても時刻の順に渡る
+    worker: AudioWorker
+    on_reject: workerのキューが一杯で渡せなかったときに呼ばれる関数 on_reject(func, args)
+    maxsize: 予約しておける最大数
+    '''
+    def __init__(self, worker, on_reject=None, maxsize=1024):
+        self.worker = worker
+        self.on_reject = on_reject
+        self.maxsize = maxsize
+        self.rejected = 0
+        self._heap = []  # (時刻, 通し番号, func, args)
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, due, func, *args):
+        '''due（perf_counter）にfuncをworkerに渡す。予約が一杯ならFalseを返す'''
+        with self._condition:
+            if len(self._heap) >= self.maxsize:
+                self.rejected += 1
+                return False
+            self._counter += 1
+            heapq.heappush(self._heap, (due, self._counter, func, args))
+            self._condition.notify()
+            return True
+
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        with self._condition:
+            while self._running:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                remaining = self._heap[0][0] - time.perf_counter()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                _, _, func, args = heapq.heappop(self._heap)
+                if not self.worker.submit(func, *args):
+                    self.rejected += 1
+                    if self.on_reject is not None:
+                        self.on_reject(func, args)
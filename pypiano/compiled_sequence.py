@@ -0,0 +1,112 @@
+'''グリッドを再生用のイベント列に変換し、編集された部分だけを作り直す'''
+from bisect import bisect_left
+
+from grid_model import EMPTY, IS_DRUM, NOTE_TABLE
+
+# イベントの種類（同じtickではnote_off → note_on → ドラムの順に並ぶ）
+NOTE_OFF = 0
+NOTE_ON = 1
+DRUM = 2
+
+
+class CompiledSequence:
+    '''
+    イベントは (tick, 種類, 行, チャンネル, 値) のタプルで、tick順に並んだ1本のリストに入る
+    値はノートならMIDIノート番号、ドラムならパレット番号
+    続いている同じ音は1つのnote_on/note_offにまとめる
+    grid: GridModel
+    row_channels: 行ごとのMIDIチャンネル（省略時や、足りない行は0）
+    '''
+    def __init__(self, grid, row_channels=None):
+        self.grid = grid
+        row_channels = list(row_channels or [])[:grid.rows]
+        self.row_channels = row_channels + [0] * (grid.rows - len(row_channels))
+        self.events = []
+        self.compile()
+
+    def compile(self):
+        '''グリッド全体をコンパイルし直す（起動時・クリア時）'''
+        events = []
+        for row in range(self.grid.rows):
+            events.extend(self._row_events(row, 0, self.grid.cols - 1))
+        events.sort()
+        self.events = events
+
+    def update_cell(self, row, col):
+        '''セルの編集後、そのセルを含む行の区間だけイベントを作り直す'''
+        lo, hi = self._affected_segment(row, col)
+        # 区間内で鳴り始めるイベントと、その音のnote_off（lo より後、hi + 1 まで）を入れ替える
+        # 再生スレッドが途中の状態を読まないように、新しいリストを作ってから1回で差し替える
+        events = self.events
+        start = bisect_left(events, (lo,))
+        end = bisect_left(events, (hi + 2,), start)
+        segment = [event for event in events[start:end] if not self._in_segment(event, row, lo, hi)]
+        segment.extend(self._row_events(row, lo, hi))
+        segment.sort()
+        self.events = events[:start] + segment + events[end:]
+
+    def events_at(self, tick):
+        events = self.events
+        start = bisect_left(events, (tick,))
+        end = bisect_left(events, (tick + 1,), start)
+        return events[start:end]
+
+    def events_for_step(self, col):
+        '''列に入ったときに処理するイベント。先頭の列では前の周の終わりのnote_offも含める'''
+        if col == 0:
+            return self.events_at(self.grid.cols) + self.events_at(0)
+        return self.events_at(col)
+
+    def sounding(self, col):
+        '''列colで鳴っている音を {(チャンネル, ノート)} で返す'''
+        notes = set()
+        for row in range(self.grid.rows):
+            cell = self.grid.get(row, col)
+            if cell != EMPTY and not IS_DRUM[cell]:
+                notes.add((self.row_channels[row], NOTE_TABLE[cell]))
+        return notes
+
+    @staticmethod
+    def _in_segment(event, row, lo, hi):
+        tick, kind, event_row = event[:3]
+        if event_row != row:
+            return False
+        if kind == NOTE_OFF:
+            return lo < tick <= hi + 1
+        return lo <= tick <= hi
+
+    def _affected_segment(self, row, col):
+        # 編集前の連続区間は両隣のセルと同じ値の範囲に必ず含まれる
+        lo = hi = col
+        left = self.grid.get(row, col - 1) if col > 0 else EMPTY
+        if left != EMPTY:
+            lo = col - 1
+            while lo > 0 and self.grid.get(row, lo - 1) == left:
+                lo -= 1
+        right = self.grid.get(row, col + 1) if col + 1 < self.grid.cols else EMPTY
+        if right != EMPTY:
+            hi = col + 1
+            while hi + 1 < self.grid.cols and self.grid.get(row, hi + 1) == right:
+                hi += 1
+        return lo, hi
+
+    def _row_events(self, row, lo, hi):
+        channel = self.row_channels[row]
+        events = []
+        col = lo
+        while col <= hi:
+            cell = self.grid.get(row, col)
+            if cell == EMPTY:
+                col += 1
+            elif IS_DRUM[cell]:
+                events.append((col, DRUM, row, channel, cell))
+                col += 1
+            else:
+                end = col + 1
+                while end <= hi and self.grid.get(row, end) == cell:
+                    end += 1
+                note = NOTE_TABLE[cell]
+                events.append((col, NOTE_ON, row, channel, note))
+                events.append((end, NOTE_OFF, row, channel, note))
+                col = end
+        return events
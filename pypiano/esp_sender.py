@@ -0,0 +1,129 @@
+'''UIスレッドを止めずにESPへ色を送信するバックグラウンド送信器'''
+import queue
+import socket
+import struct
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from grid_model import COLOR_TABLE, ESP_PAYLOAD_TABLE, esp_payload
+
+# UDPで送る1フレーム: シーケンス番号, R, G, B の4バイト
+COLOR_PACKET = struct.Struct('!BBBB')
+
+# パレットの色はJSONの本文を作っておき、送るたびにエンコードしない
+PAYLOADS = dict(zip(COLOR_TABLE, ESP_PAYLOAD_TABLE))
+
+
+def pack_color(seq, r, g, b):
+    return COLOR_PACKET.pack(seq & 0xFF, r, g, b)
+
+
+class HTTPTransport:
+    '''JSONをPOSTする従来の送り方。keep-aliveの接続を使い回す'''
+    def __init__(self, url, timeout=0.5):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+    def send(self, r, g, b):
+        body = PAYLOADS.get((r, g, b))
+        if body is None:
+            body = esp_payload((r, g, b))
+        response = self.session.post(self.url, data=body, timeout=self.timeout,
+                                     headers={'Content-Type': 'application/json'})
+        if response.status_code != 200:
+            print(f"Failed to send color data. Status code: {response.status_code}")
+            return False
+        return True
+
+    def close(self):
+        self.session.close()
+
+
+class UDPTransport:
+    '''1つのソケットを開いたまま4バイトのデータグラムを送る。シーケンサーの速度で色を流せる'''
+    def __init__(self, host, port, timeout=0.5):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect((host, port))
+        self.seq = 0
+
+    def send(self, r, g, b):
+        self.sock.send(pack_color(self.seq, r, g, b))
+        self.seq = (self.seq + 1) & 0xFF
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+class ESPColorSender:
+    '''
+    url: ESPのエンドポイント（transportを指定しないときはHTTPで送る）
+    timeout: 接続・応答のタイムアウト（秒）
+    max_retries: 送信に失敗したときの再試行回数
+    backoff: 再試行の待ち時間の初期値（秒）。失敗するたびに倍にする
+    transport: HTTPTransport または UDPTransport
+    '''
+    def __init__(self, url=None, timeout=0.5, max_retries=3, backoff=0.1, transport=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.transport = transport if transport is not None else HTTPTransport(url, timeout)
+        # 最新の色だけを保持する（後から来た色で上書き）
+        self._queue = queue.Queue(maxsize=1)
+        self._stop_event = threading.Event()
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0  # 送信前に新しい色で置き換えられた数
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, r, g, b):
+        '''色を送信キューに置いてすぐに戻る'''
+        self._put((r, g, b))
+
+    def close(self):
+        self._stop_event.set()
+        self._put(None)
+        self._thread.join()
+        self.transport.close()
+
+    def _put(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.coalesced += 1
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        while True:
+            color = self._queue.get()
+            if color is None:
+                break
+            self._post(color)
+
+    def _post(self, color):
+        r, g, b = color
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.transport.send(r, g, b):
+                    self.sent += 1
+                    return
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f"Error sending data to ESP: {e}")
+            # 待っている間に新しい色が来たら古い色の再送はやめる
+            if attempt == self.max_retries or not self._queue.empty():
+                break
+            if self._stop_event.wait(delay):
+                break
+            delay *= 2
+        self.failed += 1
@@ -0,0 +1,109 @@
+'''実機なしで送信速度と遅延を測るためのESPの代わりのサーバー'''
+import json
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from esp_sender import COLOR_PACKET, HTTPTransport, UDPTransport
+
+HTTP_PORT = 5000
+UDP_PORT = 5001
+
+
+class ColorHandler(BaseHTTPRequestHandler):
+    # keep-aliveに対応させ、Nagleで応答が遅れないようにする
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        if self.path != '/ws':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        json.loads(self.rfile.read(length))
+        body = b'OK'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(host='127.0.0.1', port=HTTP_PORT):
+    server = ThreadingHTTPServer((host, port), ColorHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_udp_server(host='127.0.0.1', port=UDP_PORT):
+    '''受け取ったデータグラムをそのまま送り返す（往復遅延の計測用）'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+
+    def serve():
+        while True:
+            try:
+                data, addr = sock.recvfrom(COLOR_PACKET.size)
+            except OSError:
+                break
+            sock.sendto(data, addr)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock
+
+
+def summarize(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    print(f"{name}: {count} colors in {elapsed:.3f}s ({count / elapsed:.0f}/s), "
+          f"latency median {latencies[count // 2] * 1000:.3f}ms, "
+          f"p99 {latencies[int(count * 0.99) - 1] * 1000:.3f}ms")
+
+
+def benchmark(count=500):
+    http_server = start_http_server()
+    udp_server = start_udp_server()
+
+    # HTTP: 1色ごとに応答が返るまでの時間
+    transport = HTTPTransport(f"http://127.0.0.1:{HTTP_PORT}/ws")
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        transport.send(i % 256, 0, 0)
+        latencies.append(time.perf_counter() - t)
+    summarize("HTTP", latencies, time.perf_counter() - start)
+    transport.close()
+
+    # UDP: 送ったデータグラムが送り返されるまでの時間
+    transport = UDPTransport('127.0.0.1', UDP_PORT)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        transport.send(i % 256, 0, 0)
+        transport.sock.recv(COLOR_PACKET.size)
+        latencies.append(time.perf_counter() - t)
+    summarize("UDP", latencies, time.perf_counter() - start)
+    transport.close()
+
+    http_server.shutdown()
+    udp_server.close()
+
+
+if __name__ == '__main__':
+    if '--bench' in sys.argv:
+        benchmark()
+    else:
+        start_http_server('0.0.0.0')
+        start_udp_server('0.0.0.0')
+        print(f"ESP stand-in listening on http://0.0.0.0:{HTTP_PORT}/ws and udp://0.0.0.0:{UDP_PORT}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,53 @@
+'''Server-Sent Eventsでブラウザにイベントを配信する'''
+import json
+import queue
+import threading
+
+
+class EventBroadcaster:
+    '''
+    publishしたイベントを、接続している全てのクライアントのキューに配る
+    maxsize: クライアントごとに溜める最大数（溢れたら古いものから捨てる）
+    '''
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        client = queue.Queue(self.maxsize)
+        with self._lock:
+            self._clients.append(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def publish(self, event, data):
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            while True:
+                try:
+                    client.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        client.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def stream(self, heartbeat=15):
+        '''Flaskのレスポンスに渡すジェネレーター。無通信の間はコメント行で接続を保つ'''
+        client = self.subscribe()
+        try:
+            while True:
+                try:
+                    yield client.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+        finally:
+            self.unsubscribe(client)
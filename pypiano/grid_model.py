@@ -0,0 +1,128 @@
+'''パレット番号を配列で持つグリッドのデータと、色・音の対応表
+
+色と音の対応はここだけに書き、pypianoのスクリプト・app.py・ブラウザ（/palette）で共有する
+'''
+import json
+from array import array
+from itertools import groupby
+
+# 色と音のマッピング
+color_note_map = {
+    "Red": {"note": 60, "color": (255, 0, 0)},  # C4
+    "Orange-pink": {"note": 67, "color": (255, 153, 102)},  # G4 (#FF9966)
+    "Yellow": {"note": 62, "color": (255, 255, 0)},  # D4
+    "Green": {"note": 69, "color": (0, 255, 0)},  # A4
+    "Whitish-blue": {"note": 64, "color": (224, 255, 255)},  # E4 (#E0FFFF)
+    "Blue, bright": {"note": 66, "color": (0, 0, 255)},  # F#4
+    "Violet": {"note": 61, "color": (238, 130, 238)},  # Db4
+    "Purplish-violet": {"note": 68, "color": (75, 0, 130)},  # Ab4 (Indigo)
+    "Steel color with metallic sheen": {"note": 65, "color": (70, 130, 180)},  # Eb4 (Steel Blue)
+    "Red, dark": {"note": 63, "color": (139, 0, 0)}  # F4
+}
+
+# ドラム専用の色（"voices"で同時発音数、"choke"で互いに止め合うグループを指定できる）
+# "gm_note"はMIDIファイルに書き出すときのGMドラムのノート番号
+drum_color_map = {
+    "White": {"sample": "hat.wav", "color": (255, 255, 255), "gm_note": 42},  # Closed Hi-Hat
+    "Black": {"sample": "kick.wav", "color": (1, 1, 1), "gm_note": 36}  # Bass Drum 1
+}
+
+# パレット番号の対応表（0は空のセル）
+# 色の追加・並べ替えで番号が変わるときはMAPPING_VERSIONを上げる（保存したパターンの番号と合わなくなるため）
+MAPPING_VERSION = 1
+EMPTY = 0
+EMPTY_COLOR = (255, 255, 255)
+PALETTE_NAMES = [None] + list(color_note_map) + list(drum_color_map)
+PALETTE_IDS = {name: i for i, name in enumerate(PALETTE_NAMES) if name is not None}
+NOTE_TABLE = array('b', [-1] + [value["note"] for value in color_note_map.values()]
+                   + [-1] * len(drum_color_map))  # ドラムは-1
+COLOR_TABLE = [EMPTY_COLOR] + [value["color"] for value in color_note_map.values()] \
+    + [value["color"] for value in drum_color_map.values()]
+IS_DRUM = array('B', [0] * (1 + len(color_note_map)) + [1] * len(drum_color_map))
+DRUM_SAMPLES = {PALETTE_IDS[name]: value for name, value in drum_color_map.items()}  # SampleBankに渡す
+
+
+def esp_payload(color):
+    '''ESPにHTTPで送るJSONの本文'''
+    r, g, b = color
+    return json.dumps({"r": r, "g": g, "b": b}).encode()
+
+
+ESP_PAYLOAD_TABLE = [esp_payload(color) for color in COLOR_TABLE]
+
+
+def palette_table():
+    '''ブラウザに渡す対応表（JSONにできる形）'''
+    palette = []
+    for palette_id, name in enumerate(PALETTE_NAMES):
+        if name is None:
+            continue
+        entry = {
+            "id": palette_id,
+            "name": name,
+            "color": "#%02x%02x%02x" % COLOR_TABLE[palette_id],
+            "drum": bool(IS_DRUM[palette_id]),
+        }
+        if IS_DRUM[palette_id]:
+            entry["sample"] = drum_color_map[name]["sample"]
+        else:
+            entry["note"] = NOTE_TABLE[palette_id]
+        palette.append(entry)
+    return {"mapping_version": MAPPING_VERSION, "palette": palette}
+
+
+class GridModel:
+    '''
+    セルごとにパレット番号を1バイトで持つグリッド
+    rows: 行数
+    cols: 列数
+    '''
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.cells = array('B', bytes(rows * cols))
+
+    @classmethod
+    def from_names(cls, rows):
+        '''色の名前（空はNone）の2次元リストから作る。知らない名前は空のセルにする'''
+        grid = cls(len(rows), len(rows[0]))
+        for row, cells in enumerate(rows):
+            for col, key in enumerate(cells[:grid.cols]):
+                grid.set(row, col, PALETTE_IDS.get(key, EMPTY))
+        return grid
+
+    def to_names(self):
+        return [[PALETTE_NAMES[cell] for cell in self.row_cells(row)] for row in range(self.rows)]
+
+    def get(self, row, col):
+        return self.cells[row * self.cols + col]
+
+    def set(self, row, col, palette_id):
+        self.cells[row * self.cols + col] = palette_id
+
+    def clear(self):
+        self.cells = array('B', bytes(self.rows * self.cols))
+
+    def color(self, row, col):
+        return COLOR_TABLE[self.get(row, col)]
+
+    def row_cells(self, row):
+        start = row * self.cols
+        return self.cells[start:start + self.cols]
+
+    def column(self, col):
+        return self.cells[col::self.cols]
+
+    def runs(self, row):
+        '''行を (開始列, 長さ, パレット番号) の連続区間に分ける。空の区間は含めない'''
+        result = []
+        col = 0
+        for palette_id, group in groupby(self.row_cells(row)):
+            length = sum(1 for _ in group)
+            if palette_id != EMPTY:
+                if IS_DRUM[palette_id]:
+                    result.extend((col + i, 1, palette_id) for i in range(length))
+                else:
+                    result.append((col, length, palette_id))
+            col += length
+        return result
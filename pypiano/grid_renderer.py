@@ -0,0 +1,110 @@
+'''変化した部分だけを描き直すグリッドの描画'''
+import pygame
+
+from hit_test import HitGrid
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+BAR_COLOR = (255, 255, 0)
+
+
+class GridRenderer:
+    '''
+    グリッド・五線譜・パレットを背景のSurfaceに描いておき、
+    編集されたセルと再生バーの前後の位置だけを画面に反映する
+    screen: 描画先の画面
+    rows, cols: グリッドの行数と列数
+    cell_width, cell_height: セルの大きさ
+    canvas_width, canvas_height: グリッド部分の大きさ
+    palette_colors: パレットに並べる色のリスト
+    '''
+    palette_x = 20
+    palette_offset = 10  # グリッドの下からパレットまでの間隔
+    button_size = 50
+    button_gap = 10
+
+    def __init__(self, screen, rows, cols, cell_width, cell_height, canvas_width, canvas_height, palette_colors):
+        self.screen = screen
+        self.rows = rows
+        self.cols = cols
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+        self.palette_colors = palette_colors
+        self.background = pygame.Surface(screen.get_size())
+        self.dirty_rects = []
+        self.bar_rect = None
+        # パレットのボタンは位置が変わらないので一度だけ索引を作る
+        self.palette_hits = HitGrid.from_items((self.palette_rect(i), i) for i in range(len(palette_colors)))
+
+    def cell_rect(self, row, col):
+        return pygame.Rect(col * self.cell_width, row * self.cell_height, self.cell_width, self.cell_height)
+
+    def palette_rect(self, i):
+        return pygame.Rect(self.palette_x + i * (self.button_size + self.button_gap),
+                           self.canvas_height + self.palette_offset, self.button_size, self.button_size)
+
+    def palette_at(self, pos):
+        '''posにあるパレットのボタンの番号を返す。なければNone'''
+        return self.palette_hits.find(pos)
+
+    def rebuild(self, grid):
+        '''背景をすべて描き直して画面全体を更新する（起動時・クリア時）。gridはGridModel'''
+        self.background.fill(WHITE)
+        for row in range(self.rows):
+            for col in range(self.cols):
+                self._draw_cell(row, col, grid.color(row, col))
+        self._draw_staves()
+        for i, color in enumerate(self.palette_colors):
+            pygame.draw.rect(self.background, color, self.palette_rect(i))
+        self.screen.blit(self.background, (0, 0))
+        self.bar_rect = None
+        self.dirty_rects = []
+        pygame.display.flip()
+
+    def mark_cell(self, row, col, color):
+        '''編集されたセルだけを背景に描き直す'''
+        self._draw_cell(row, col, color)
+        rect = self.cell_rect(row, col)
+        self.background.set_clip(rect)
+        self._draw_staves()
+        self.background.set_clip(None)
+        self.dirty_rects.append(rect)
+
+    def set_playback_bar(self, progress):
+        '''再生バーを移動する。progressがNoneなら消す'''
+        new_rect = None
+        if progress is not None:
+            new_rect = pygame.Rect(int(progress * self.canvas_width), 0, self.cell_width, self.canvas_height)
+        if new_rect == self.bar_rect:
+            return
+        if self.bar_rect is not None:
+            self.dirty_rects.append(self.bar_rect)
+        if new_rect is not None:
+            self.dirty_rects.append(new_rect)
+        self.bar_rect = new_rect
+
+    def present(self):
+        '''変化した部分だけを画面に転送する'''
+        if not self.dirty_rects:
+            return
+        for rect in self.dirty_rects:
+            self.screen.blit(self.background, rect, rect)
+        if self.bar_rect is not None:
+            pygame.draw.rect(self.screen, BAR_COLOR, self.bar_rect)
+        pygame.display.update(self.dirty_rects)
+        self.dirty_rects = []
+
+    def _draw_cell(self, row, col, color):
+        rect = self.cell_rect(row, col)
+        pygame.draw.rect(self.background, color, rect)
+        pygame.draw.rect(self.background, BLACK, rect, 1)
+
+    def _draw_staves(self):
+        for row in range(2):  # 上2行のみ
+            start_y = row * self.cell_height
+            line_spacing = self.cell_height // 6
+            for i in range(1, 6):
+                y_pos = start_y + i * line_spacing
+                pygame.draw.line(self.background, BLACK, (0, y_pos), (self.canvas_width, y_pos), 1)
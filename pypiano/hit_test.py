@@ -0,0 +1,37 @@
+'''座標から鍵盤やパレットのボタンを一定時間で引く空間インデックス'''
+
+
+class HitGrid:
+    '''
+    画面を cell × cell の升目に分け、升目ごとに重なっている矩形を覚えておく
+    クリックやドラッグのたびに全ての矩形を調べずに、升目1つ分だけを見ればよい
+    後から追加した矩形ほど手前にある（黒鍵を白鍵の後に追加すれば黒鍵が優先される）
+    cell: 升目の大きさ（px）。一番小さい矩形の幅くらいにすると升目あたりの矩形が少なくなる
+    '''
+    def __init__(self, cell=16):
+        self.cell = cell
+        self._buckets = {}  # (升目x, 升目y) -> [(rect, value), ...]（手前のものが先）
+
+    @classmethod
+    def from_items(cls, items, cell=16):
+        '''(rect, value) を奥から手前の順に並べたものから作る'''
+        hits = cls(cell)
+        for rect, value in items:
+            hits.add(rect, value)
+        return hits
+
+    def add(self, rect, value):
+        cell = self.cell
+        for bx in range(rect.left // cell, (rect.right - 1) // cell + 1):
+            for by in range(rect.top // cell, (rect.bottom - 1) // cell + 1):
+                self._buckets.setdefault((bx, by), []).insert(0, (rect, value))
+
+    def find(self, pos):
+        '''posにある一番手前の値を返す。なければNone'''
+        x, y = pos
+        bucket = self._buckets.get((x // self.cell, y // self.cell))
+        if bucket is not None:
+            for rect, value in bucket:
+                if rect.collidepoint(x, y):
+                    return value
+        return None
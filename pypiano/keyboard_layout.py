@@ -0,0 +1,154 @@
+'''任意の音域の鍵盤を並べるレイアウトと、キャッシュしたSurfaceで描く描画'''
+from array import array
+
+import pygame
+
+BLACK_PITCHES = (1, 3, 6, 8, 10)  # C#, D#, F#, G#, A#
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+
+
+def is_black(note):
+    return note % 12 in BLACK_PITCHES
+
+
+def wait_events(timeout):
+    '''入力が来るまで（最大timeoutミリ秒）眠り、溜まっているイベントをまとめて返す'''
+    event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return []
+    return [event] + pygame.event.get()
+
+
+class KeyboardLayout:
+    '''
+    鍵盤の位置・ノート・チャンネルを、鍵盤の番号で引ける平らな配列で持つ
+    並びは白鍵がすべて先で黒鍵が後（描画とHitGridへの追加の順）
+    manuals: [(最低音, 最高音, チャンネル), ...] 上から順に並べる段（88鍵なら [(21, 108, 0)]）
+             音域の端が黒鍵のときは、隣の白鍵まで広げる
+             4つ目に True を付けた段 (最低音, 最高音, チャンネル, True) は白鍵だけを並べる
+    key_width, key_height: 白鍵の大きさ
+    black_width, black_height: 黒鍵の大きさ（黒鍵は左右の白鍵の境目に中心を置く）
+    gap: 段と段の間隔
+    '''
+    def __init__(self, manuals, key_width=40, key_height=200, black_width=25, black_height=120, gap=10):
+        self.rects = []
+        self.notes = array('B')
+        self.channels = array('B')
+        self.black = array('B')
+        self.manual = array('B')
+        self.width = 0
+
+        whites = []
+        blacks = []
+        y = 0
+        for m, manual in enumerate(manuals):
+            low, high, channel = manual[:3]
+            white_only = len(manual) > 3 and manual[3]
+            if is_black(low):
+                low -= 1
+            if is_black(high):
+                high += 1
+            white_count = 0
+            for note in range(low, high + 1):
+                if is_black(note):
+                    if white_only:
+                        continue
+                    # 直前の白鍵の右端が中心になる
+                    x = white_count * key_width - black_width // 2
+                    blacks.append((pygame.Rect(x, y, black_width, black_height), note, channel, m))
+                else:
+                    whites.append((pygame.Rect(white_count * key_width, y, key_width, key_height), note, channel, m))
+                    white_count += 1
+            self.width = max(self.width, white_count * key_width)
+            y += key_height + gap
+        self.height = max(y - gap, 0)
+
+        for kind, keys in ((0, whites), (1, blacks)):
+            for rect, note, channel, m in keys:
+                self.rects.append(rect)
+                self.notes.append(note)
+                self.channels.append(channel)
+                self.black.append(kind)
+                self.manual.append(m)
+
+        self.index = {(channel, note): i for i, (channel, note) in enumerate(zip(self.channels, self.notes))}
+        # 白鍵ごとに、上に重なっている黒鍵（同じ段で半音隣のもの）
+        self.overlaps = [[] for _ in self.rects]
+        by_note = {(m, note): i for i, (m, note) in enumerate(zip(self.manual, self.notes))}
+        for i, note in enumerate(self.notes):
+            if not self.black[i]:
+                for neighbor in (note - 1, note + 1):
+                    j = by_note.get((self.manual[i], neighbor))
+                    if j is not None and self.black[j]:
+                        self.overlaps[i].append(j)
+
+    def __len__(self):
+        return len(self.rects)
+
+    def items(self):
+        '''HitGrid.from_itemsに渡す (rect, 鍵盤の番号)'''
+        return zip(self.rects, range(len(self.rects)))
+
+
+class KeyboardRenderer:
+    '''
+    鍵盤全体を1枚のSurfaceに描いておき、色が変わった鍵盤だけを描き直す
+    鍵盤1つ分のSurfaceは (白鍵/黒鍵, 色) ごとにキャッシュして使い回す
+    描き直した範囲は dirty_rects に溜まり、presentで画面に反映する
+    '''
+    def __init__(self, layout, background=WHITE, border=BLACK):
+        self.layout = layout
+        self.border = border
+        self.surface = pygame.Surface((max(layout.width, 1), max(layout.height, 1)))
+        self.surface.fill(background)
+        self.base_colors = [BLACK if black else WHITE for black in layout.black]
+        self.colors = list(self.base_colors)
+        self._cache = {}
+        for i in range(len(layout)):
+            self._blit(i)
+        self.dirty_rects = [self.surface.get_rect()]
+
+    def _key_surface(self, i, color):
+        rect = self.layout.rects[i]
+        black = self.layout.black[i]
+        cache_key = (black, rect.size, color)
+        surface = self._cache.get(cache_key)
+        if surface is None:
+            surface = pygame.Surface(rect.size)
+            surface.fill(color)
+            if not black:
+                pygame.draw.rect(surface, self.border, surface.get_rect(), 1)
+            self._cache[cache_key] = surface
+        return surface
+
+    def _blit(self, i):
+        self.surface.blit(self._key_surface(i, self.colors[i]), self.layout.rects[i])
+
+    def set_color(self, i, color):
+        '''鍵盤の色を変える。同じ色なら何もしない'''
+        if self.colors[i] == color:
+            return
+        self.colors[i] = color
+        self._blit(i)
+        for j in self.layout.overlaps[i]:
+            self._blit(j)  # 白鍵を描き直したら上に重なる黒鍵も描き直す
+        self.dirty_rects.append(self.layout.rects[i])
+
+    def reset_color(self, i):
+        self.set_color(i, self.base_colors[i])
+
+    def invalidate(self):
+        '''全体を画面に写し直す（ウィンドウが隠れて戻ったときなど）'''
+        self.dirty_rects = [self.surface.get_rect()]
+
+    def present(self, screen, offset=(0, 0)):
+        '''描き直した範囲だけを画面に写して更新する'''
+        if not self.dirty_rects:
+            return
+        dx, dy = offset
+        rects = [rect.move(dx, dy) for rect in self.dirty_rects]
+        for source, target in zip(self.dirty_rects, rects):
+            screen.blit(self.surface, target, source)
+        self.dirty_rects = []
+        pygame.display.update(rects)
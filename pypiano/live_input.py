@@ -0,0 +1,92 @@
+'''パソコンのキーボードと外部MIDI入力を、専用スレッドからそのままMIDI出力に送るライブ演奏の入力層'''
+import queue
+import threading
+import time
+
+import mido
+
+from active_notes import ActiveNotes
+from audio_setup import LatencyProbe
+
+# QWERTYの2段で1オクターブ半を弾く（下の段が白鍵、上の段が黒鍵）。値はbase_noteからの半音数
+QWERTY_LAYOUT = {
+    'a': 0, 'w': 1, 's': 2, 'e': 3, 'd': 4, 'f': 5, 't': 6, 'g': 7,
+    'y': 8, 'h': 9, 'u': 10, 'j': 11, 'k': 12, 'o': 13, 'l': 14, 'p': 15, ';': 16,
+}
+
+
+class LiveInput:
+    '''
+    入力が来た時刻を付けてキューに入れ、専用のスレッドがすぐにnote_on/note_offを送る
+    GUIのフレームを待たないので、入力から出力までの遅延はスレッドが起きるまでの時間だけになる
+    GUIはon_change(channel, note, is_on)で状態を受け取って描くだけにする
+    output: MidiOutput
+    probe: 入力の種類ごと（"qwerty", "midi_in" など）に入力から送信までの遅延を記録するLatencyProbe
+    on_change: 送ったあと専用スレッドから呼ばれる（pygame.event.postなど、スレッドから呼べるものにする）
+    '''
+    def __init__(self, output, probe=None, on_change=None, channel=0):
+        self.output = output
+        self.probe = probe if probe is not None else LatencyProbe()
+        self.on_change = on_change
+        self.channel = channel
+        self.active = ActiveNotes()
+        self.pressed = set()  # 押されている (channel, note)
+        self.ports = []
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def press(self, note, velocity=100, channel=None, source="qwerty"):
+        self._queue.put((time.perf_counter(), source, True, note, velocity,
+                         self.channel if channel is None else channel))
+
+    def release(self, note, channel=None, source="qwerty"):
+        self._queue.put((time.perf_counter(), source, False, note, 0,
+                         self.channel if channel is None else channel))
+
+    def midi_callback(self, message):
+        '''mido.open_input(callback=...)に渡す。midoの受信スレッドから呼ばれる'''
+        if message.type == 'note_on' and message.velocity > 0:
+            self.press(message.note, message.velocity, message.channel, source="midi_in")
+        elif message.type in ('note_on', 'note_off'):
+            self.release(message.note, message.channel, source="midi_in")
+
+    def open_midi_input(self, name=None):
+        '''外部MIDI入力を開いて、受け取った音をこのスレッドに流す'''
+        port = mido.open_input(name, callback=self.midi_callback)
+        self.ports.append(port)
+        return port
+
+    def stats(self):
+        return {
+            "latency": self.probe.report(),
+            "histogram": self.probe.histogram(),
+            "output": self.output.stats(),
+        }
+
+    def close(self):
+        '''入力を閉じて、鳴っている音をすべて止める'''
+        for port in self.ports:
+            port.close()
+        self._queue.put(None)
+        self._thread.join()
+        self.active.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            received, source, is_on, note, velocity, channel = item
+            if is_on:
+                self.active.note_on(self.output, note, velocity, channel)
+            elif not self.active.note_off(self.output, note, channel):
+                continue
+            self.output.flush()
+            self.probe.record(source, time.perf_counter() - received)
+            if is_on:
+                self.pressed.add((channel, note))
+            else:
+                self.pressed.discard((channel, note))
+            if self.on_change is not None:
+                self.on_change(channel, note, is_on)
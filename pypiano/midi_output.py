@@ -0,0 +1,112 @@
+'''1tick分のMIDIメッセージをまとめて送る出力層'''
+import threading
+import time
+
+import mido
+
+
+class MidiOutput:
+    '''
+    port: midoの出力ポート
+    running_status: Trueならnote_offをvelocity 0のnote_onとして送り、
+                    ステータスバイトを揃えてランニングステータスが効くようにする
+    '''
+    def __init__(self, port, running_status=False):
+        self.port = port
+        self.running_status = running_status
+        self._messages = {}  # 作成済みのメッセージを使い回す
+        self._pending = {}  # (channel, note) -> このtickで送る種類のリスト
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0  # まとめたことで送らずに済んだメッセージ数
+        self.flushes = 0
+        self._window_start = time.perf_counter()
+        self._window_sent = 0
+        self._rate = 0.0
+
+    def message(self, type, note, velocity, channel=0):
+        key = (type, note, velocity, channel)
+        msg = self._messages.get(key)
+        if msg is None:
+            msg = mido.Message(type, note=note, velocity=velocity, channel=channel)
+            self._messages[key] = msg
+        return msg
+
+    def note_on(self, note, velocity=100, channel=0):
+        self._queue('note_on', note, velocity, channel)
+
+    def note_off(self, note, velocity=0, channel=0):
+        self._queue('note_off', note, velocity, channel)
+
+    def _queue(self, type, note, velocity, channel):
+        with self._lock:
+            ops = self._pending.setdefault((channel, note), [])
+            if ops and ops[-1][0] == type:
+                # 同じtickで同じ種類が重なったら1つにする
+                self.dropped += 1
+            elif ops and ops[-1][0] == 'note_on' and type == 'note_off':
+                # 同じtickで鳴らしてすぐ止める組は送らない
+                ops.pop()
+                self.dropped += 2
+                if not ops:
+                    del self._pending[(channel, note)]
+            else:
+                ops.append((type, velocity))
+
+    def flush(self):
+        '''このtickにたまったメッセージをnote_off → note_onの順にまとめて送る'''
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            offs = []
+            ons = []
+            for (channel, note), ops in pending.items():
+                for type, velocity in ops:
+                    if type == 'note_off':
+                        if self.running_status:
+                            offs.append(self.message('note_on', note, 0, channel))
+                        else:
+                            offs.append(self.message('note_off', note, velocity, channel))
+                    else:
+                        ons.append(self.message('note_on', note, velocity, channel))
+            for msg in offs + ons:
+                self.port.send(msg)
+            count = len(offs) + len(ons)
+            self.sent += count
+            self.flushes += 1
+            self._count(count)
+
+    def send(self, msg):
+        '''まとめる対象にならないメッセージをそのまま送る'''
+        with self._lock:
+            self.port.send(msg)
+            self.sent += 1
+            self._count(1)
+
+    def all_notes_off(self, channel=0):
+        '''チャンネルの全ての音を止める（All Notes Off, CC 123）'''
+        self.send(mido.Message('control_change', control=123, value=0, channel=channel))
+
+    def _count(self, count):
+        now = time.perf_counter()
+        self._window_sent += count
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            self._rate = self._window_sent / elapsed
+            self._window_start = now
+            self._window_sent = 0
+
+    def messages_per_second(self):
+        return self._rate
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "messages_per_second": self.messages_per_second(),
+        }
+
+    def close(self):
+        self.flush()
+        self.port.close()
@@ -2,6 +2,17 @@
 import pygame
 import mido
 import sys
+import time
+
+from audio_setup import init_mixer
+from active_notes import ActiveNotes
+from compiled_sequence import DRUM, NOTE_OFF, NOTE_ON, CompiledSequence
+from grid_model import DRUM_SAMPLES, EMPTY, PALETTE_IDS, GridModel, color_note_map, drum_color_map
+from grid_renderer import GridRenderer
+from midi_output import MidiOutput
+from pattern_store import PatternLibrary
+from sample_bank import SampleBank
+from sequencer import StepSequencer
 
 # Pygameの初期化
 pygame.init()
@@ -14,68 +25,26 @@ cols = 64
 cell_width = canvas_width // cols
 cell_height = 80
 
-# 色と音のマッピング
-color_note_map = {
-    "Red": {"note": 60, "color": (255, 0, 0)},  # C4
-    "Orange-pink": {"note": 67, "color": (255, 153, 102)},  # G4 (#FF9966)
-    "Yellow": {"note": 62, "color": (255, 255, 0)},  # D4
-    "Green": {"note": 69, "color": (0, 255, 0)},  # A4
-    "Whitish-blue": {"note": 64, "color": (224, 255, 255)},  # E4 (#E0FFFF)
-    "Blue, bright": {"note": 66, "color": (0, 0, 255)},  # F#4
-    "Violet": {"note": 61, "color": (238, 130, 238)},  # Db4
-    "Purplish-violet": {"note": 68, "color": (75, 0, 130)},  # Ab4 (Indigo)
-    "Steel color with metallic sheen": {"note": 65, "color": (70, 130, 180)},  # Eb4 (Steel Blue)
-    "Red, dark": {"note": 63, "color": (139, 0, 0)}  # F4
-}
-
-# ドラム専用の色
-drum_color_map = {
-    "White": {"sample": "hat.wav", "color": (255, 255, 255)},
-    "Black": {"sample": "kick.wav", "color": (1, 1, 1)}
-}
-
 # サウンドファイルの読み込み（ドラム用）
-pygame.mixer.init()
-hat_sound = pygame.mixer.Sound('hat.wav')
-kick_sound = pygame.mixer.Sound('kick.wav')
+init_mixer()  # バッファを小さくしたミキサー（環境変数で調整できる）
+drum_bank = SampleBank(DRUM_SAMPLES)  # サンプルごとに専用のチャンネルを予約する
 
 # グリッドのデータ
-grid = [[None for _ in range(cols)] for _ in range(rows)]
+grid = GridModel(rows, cols)
+sequence = CompiledSequence(grid)  # 再生用のイベント列
 selected_color = "Red"  # デフォルトの選択色
 is_erasing = False
 
 # MIDIの初期化
-outport = mido.open_output('IAC Driver My Port1')
+outport = MidiOutput(mido.open_output('IAC Driver My Port1'))
 
 # ウィンドウの設定
 screen = pygame.display.set_mode((canvas_width, canvas_height + 100))  # パレット用に高さを拡張
 pygame.display.set_caption("Interactive Music Grid")
 
-# カラーパレット描画
-def draw_palette():
-    palette_x = 20
-    palette_y = canvas_height + 10
-    button_size = 50
-
-    for i, (key, value) in enumerate(color_note_map.items()):
-        pygame.draw.rect(screen, value["color"], (palette_x + i * (button_size + 10), palette_y, button_size, button_size))
-
-# グリッドの描画
-def draw_grid():
-    for row in range(rows):
-        for col in range(cols):
-            color = (255, 255, 255) if grid[row][col] is None else grid[row][col]["color"]
-            pygame.draw.rect(screen, color, (col * cell_width, row * cell_height, cell_width, cell_height))
-            pygame.draw.rect(screen, (0, 0, 0), (col * cell_width, row * cell_height, cell_width, cell_height), 1)
-
-# 五線譜の描画
-def draw_staves():
-    for row in range(2):  # 上2行のみ
-        start_y = row * cell_height
-        line_spacing = cell_height // 6
-        for i in range(1, 6):
-            y_pos = start_y + i * line_spacing
-            pygame.draw.line(screen, (0, 0, 0), (0, y_pos), (canvas_width, y_pos), 1)
+# 背景をキャッシュし、変化した部分だけを描き直す
+renderer = GridRenderer(screen, rows, cols, cell_width, cell_height, canvas_width, canvas_height,
+                        [value["color"] for value in color_note_map.values()])
 
 # セルをクリックしたときの処理
 def handle_mouse_click(pos):
@@ -88,93 +57,92 @@ def handle_mouse_click(pos):
 
     if row < rows:
         if is_erasing:
-            grid[row][col] = None
+            grid.set(row, col, EMPTY)
         else:
             if row < 2 and selected_color in color_note_map:
-                grid[row][col] = {"key": selected_color, "color": color_note_map[selected_color]["color"]}
+                grid.set(row, col, PALETTE_IDS[selected_color])
             elif row == 2 and selected_color in drum_color_map:
-                grid[row][col] = {"key": selected_color, "color": drum_color_map[selected_color]["color"]}
+                grid.set(row, col, PALETTE_IDS[selected_color])
+
+        sequence.update_cell(row, col)
+        renderer.mark_cell(row, col, grid.color(row, col))
 
 # カラーパレットのクリック処理
+palette_keys = list(color_note_map)
+
 def handle_palette_click(pos):
-    palette_x = 20
-    palette_y = canvas_height + 10
-    button_size = 50
-    for i, key in enumerate(color_note_map.keys()):
-        palette_rect = pygame.Rect(palette_x + i * (button_size + 10), palette_y, button_size, button_size)
-        if palette_rect.collidepoint(pos):
-            return key
-    return None
+    i = renderer.palette_at(pos)
+    return palette_keys[i] if i is not None else None
 
 # 列の再生
-playing_notes = [None for _ in range(rows)]  # To store the currently playing note for each row
+active_notes = ActiveNotes()  # 鳴っている音（停止・クリア・終了時に必ず止める）
 
 def play_column(col):
-    for row in range(rows):
-        cell = grid[row][col]
-        previous_cell = grid[row][col - 1] if col > 0 else None  # Check the previous column
-
-        if cell:
-            if row < 2:  # For musical notes
-                midi_note = color_note_map[cell["key"]]["note"]
-
-                # If this cell has the same note as the previous one, sustain the note
-                if previous_cell and previous_cell == cell:
-                    continue  # Do nothing, continue the sustain
-
-                # If a new note starts, play it
-                outport.send(mido.Message('note_on', note=midi_note, velocity=100))
-                playing_notes[row] = midi_note  # Track the playing note for this row
-            elif row == 2:  # For drum sounds
-                if cell["key"] == "White":
-                    hat_sound.play()
-                elif cell["key"] == "Black":
-                    kick_sound.play()
-        else:
-            # If there was a note playing in the previous column, stop it
-            if playing_notes[row]:
-                outport.send(mido.Message('note_off', note=playing_notes[row], velocity=100))
-                playing_notes[row] = None  # Reset the playing note
-
-
-# 再生バーの描画
-def draw_playback_bar(position):
-    bar_color = (255, 255, 0, 128)  # 半透明の黄色
-    pygame.draw.rect(screen, bar_color, (position * canvas_width, 0, cell_width, canvas_height))
+    # 前の列から続いている音はコンパイル時にまとめてあるので、イベントを順に送るだけ
+    for tick, kind, row, channel, value in sequence.events_for_step(col):
+        if kind == NOTE_ON:
+            active_notes.note_on(outport, value, 100, channel)
+        elif kind == NOTE_OFF:
+            active_notes.note_off(outport, value, channel)
+        elif kind == DRUM:
+            drum_bank.play(value)
+    outport.flush()  # この列のメッセージをまとめて送る
 
 # グリッドのリセット
 def clear_grid():
-    global grid
-    grid = [[None for _ in range(cols)] for _ in range(rows)]
+    grid.clear()
+    sequence.compile()
+    active_notes.release_all(outport)
+    renderer.rebuild(grid)
 
 # 音の再生処理
-def play_sounds(progress):
-    column = int(progress * cols)
-
+def play_sounds(column):
     # If at the start, reset any sustained notes
     if column == 0:
-        for row in range(rows):
-            if playing_notes[row]:
-                outport.send(mido.Message('note_off', note=playing_notes[row], velocity=100))
-                playing_notes[row] = None  # Reset all playing notes
+        active_notes.release_all(outport, all_notes_off=False)
 
     play_column(column)
 
 # メインループ
 running = True
-is_playing = False
 clock = pygame.time.Clock()
 
 # 再生間隔と進行スピードの調整
 play_interval = 2000  # 2000msで1周
-last_time = pygame.time.get_ticks()
 
-while running:
-    screen.fill((255, 255, 255))
-    draw_grid()
-    draw_staves()
-    draw_palette()  # カラーパレットの描画
+# 保存したパターン（Sキーで保存、起動時に名前を渡すと開く）
+library = PatternLibrary()
+
+def save_pattern():
+    name = time.strftime('%Y%m%d-%H%M%S')
+    library.save(name, grid, play_interval / cols)
+    print("保存しました:", name)
 
+def open_pattern(name):
+    global play_interval
+    try:
+        loaded, step_ms = library.load(name)
+    except FileNotFoundError:
+        print("パターンが見つかりません:", name)
+        return
+    except ValueError as e:
+        print("開けません:", e)
+        return
+    if (loaded.rows, loaded.cols) != (rows, cols):
+        print(f"{name} は {loaded.rows}x{loaded.cols} のパターンなので開けません")
+        return
+    grid.cells = loaded.cells
+    sequence.compile()
+    play_interval = step_ms * cols
+
+if len(sys.argv) > 1:
+    open_pattern(sys.argv[1])
+
+sequencer = StepSequencer(cols, play_interval, play_sounds)
+
+renderer.rebuild(grid)
+
+while running:
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             running = False
@@ -186,26 +154,23 @@ while running:
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_c:
                 clear_grid()
+            elif event.key == pygame.K_s:
+                save_pattern()
             elif event.key == pygame.K_SPACE:
-                is_playing = not is_playing
-
-    # 再生中の処理
-    if is_playing:
-        current_time = pygame.time.get_ticks()
-        elapsed_time = current_time - last_time
-
-        # 再生バーの位置を滑らかに進行
-        progress = (elapsed_time % play_interval) / play_interval
-        draw_playback_bar(progress)
-
-        # 音を再生
-        play_sounds(progress)
-
-        if elapsed_time >= play_interval:
-            last_time = current_time
+                sequencer.toggle()
+                if not sequencer.is_running:
+                    active_notes.release_all(outport)  # 停止したら鳴っている音を止める
 
-    pygame.display.flip()
+    # 再生バーの移動と、変化した部分だけの画面更新
+    renderer.set_playback_bar(sequencer.progress() if sequencer.is_running else None)
+    renderer.present()
     clock.tick(60)
 
+sequencer.stop()
+active_notes.close()
+print("ステップのタイミング誤差:", sequencer.timing_report())
+print("MIDI出力:", outport.stats())
+print("ドラム:", drum_bank.stats())
+outport.close()
 pygame.quit()
 sys.exit()
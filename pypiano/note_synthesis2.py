@@ -2,6 +2,9 @@ import pygame
 import mido
 import sys
 
+from audio_setup import init_mixer
+from grid_model import EMPTY, PALETTE_IDS, GridModel, color_note_map, drum_color_map
+
 # Pygameの初期化
 pygame.init()
 
@@ -11,33 +14,11 @@ canvas_height = 240  # 3行で1行80px
 rows = 1
 cols = 64
 
-# 色と音のマッピング
-color_note_map = {
-    "Red": {"note": 60, "color": (255, 0, 0)},  # C4
-    "Orange-pink": {"note": 67, "color": (255, 153, 102)},  # G4 (#FF9966)
-    "Yellow": {"note": 62, "color": (255, 255, 0)},  # D4
-    "Green": {"note": 69, "color": (0, 255, 0)},  # A4
-    "Whitish-blue": {"note": 64, "color": (224, 255, 255)},  # E4 (#E0FFFF)
-    "Blue, bright": {"note": 66, "color": (0, 0, 255)},  # F#4
-    "Violet": {"note": 61, "color": (238, 130, 238)},  # Db4
-    "Purplish-violet": {"note": 68, "color": (75, 0, 130)},  # Ab4 (Indigo)
-    "Steel color with metallic sheen": {"note": 65, "color": (70, 130, 180)},  # Eb4 (Steel Blue)
-    "Red, dark": {"note": 63, "color": (139, 0, 0)}  # F4
-}
-
-# ドラム専用の色
-drum_color_map = {
-    "White": {"sample": "hat.wav", "color": (255, 255, 255)},
-    "Black": {"sample": "kick.wav", "color": (1, 1, 1)}
-}
-
-# サウンドファイルの読み込み（ドラム用）
-pygame.mixer.init()
-hat_sound = pygame.mixer.Sound('hat.wav')
-kick_sound = pygame.mixer.Sound('kick.wav')
+# ミキサーの初期化
+init_mixer()  # バッファを小さくしたミキサー（環境変数で調整できる）
 
 # グリッドのデータ
-grid = [[None for _ in range(cols)] for _ in range(rows)]
+grid = GridModel(rows, cols)
 selected_color = "Red"  # デフォルトの選択色
 is_erasing = False
 
@@ -52,7 +33,7 @@ pygame.display.set_caption("Interactive Music Grid")
 def draw_grid(cell_width, cell_height):
     for row in range(rows):
         for col in range(cols):
-            color = (255, 255, 255) if grid[row][col] is None else grid[row][col]["color"]
+            color = grid.color(row, col)
             pygame.draw.rect(screen, color, (col * cell_width, row * cell_height, cell_width, cell_height))
             pygame.draw.rect(screen, (0, 0, 0), (col * cell_width, row * cell_height, cell_width, cell_height), 1)
 
@@ -75,12 +56,12 @@ def handle_mouse_click(pos, cell_width, cell_height):
 
     if row < rows:
         if is_erasing:
-            grid[row][col] = None
+            grid.set(row, col, EMPTY)
         else:
             if row < 2 and selected_color in color_note_map:
-                grid[row][col] = {"key": selected_color, "color": color_note_map[selected_color]["color"]}
+                grid.set(row, col, PALETTE_IDS[selected_color])
             elif row == 2 and selected_color in drum_color_map:
-                grid[row][col] = {"key": selected_color, "color": drum_color_map[selected_color]["color"]}
+                grid.set(row, col, PALETTE_IDS[selected_color])
 
 # メインループ
 running = True
@@ -108,7 +89,7 @@ while running:
                 handle_mouse_click(pygame.mouse.get_pos(), cell_width, cell_height)
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_c:
-                clear_grid()
+                grid.clear()
             elif event.key == pygame.K_SPACE:
                 is_playing = not is_playing
 
@@ -0,0 +1,205 @@
+'''グリッドをリアルタイムで鳴らさずに、MIDIファイルとWAVファイルに書き出す
+
+使い方:
+    python offline_render.py パターン [パターン ...] [--out 出力先] [--loops 回数]
+パターンは保存したバイナリ（.ppat）か、/pattern と同じ形のJSON {"grid": [["Red", null, ...], ...], "step_ms": 600}
+'''
+import json
+import math
+import operator
+import os
+import sys
+import time
+import wave
+from array import array
+
+import mido
+
+from compiled_sequence import DRUM, NOTE_OFF, NOTE_ON, CompiledSequence
+from grid_model import DRUM_SAMPLES, IS_DRUM, NOTE_TABLE, GridModel
+from pattern_store import PATTERN_EXT
+from pattern_store import load_pattern as load_binary_pattern
+from sample_bank import SAMPLE_DIR
+
+SAMPLE_RATE = 44100
+TICKS_PER_BEAT = 480
+STEPS_PER_BEAT = 4  # 1列を16分音符として書き出す
+DRUM_CHANNEL = 9  # GMのドラムチャンネル（10ch）
+
+
+def render_midi(grid, step_ms, path, row_channels=None, loops=1):
+    '''グリッドをStandard MIDI File（フォーマット0）に書き出す'''
+    sequence = CompiledSequence(grid, row_channels)
+    ticks_per_step = TICKS_PER_BEAT // STEPS_PER_BEAT
+    midi = mido.MidiFile(type=0, ticks_per_beat=TICKS_PER_BEAT)
+    track = mido.MidiTrack()
+    midi.tracks.append(track)
+    track.append(mido.MetaMessage('set_tempo', tempo=int(step_ms * STEPS_PER_BEAT * 1000)))
+
+    # (tick, 順番, メッセージ) を集めてから差分時間に直す
+    timeline = []
+    for loop in range(loops):
+        offset = loop * grid.cols * ticks_per_step
+        for tick, kind, row, channel, value in sequence.events:
+            at = offset + tick * ticks_per_step
+            if kind == NOTE_ON:
+                timeline.append((at, 1, mido.Message('note_on', note=value, velocity=100, channel=channel)))
+            elif kind == NOTE_OFF:
+                timeline.append((at, 0, mido.Message('note_off', note=value, channel=channel)))
+            elif kind == DRUM:
+                note = DRUM_SAMPLES[value].get("gm_note")
+                if note is None:
+                    continue
+                timeline.append((at, 1, mido.Message('note_on', note=note, velocity=100, channel=DRUM_CHANNEL)))
+                timeline.append((at + ticks_per_step // 2, 0,
+                                 mido.Message('note_off', note=note, channel=DRUM_CHANNEL)))
+    timeline.sort(key=lambda item: (item[0], item[1]))
+
+    previous = 0
+    for at, _, message in timeline:
+        track.append(message.copy(time=at - previous))
+        previous = at
+    track.append(mido.MetaMessage('end_of_track', time=loops * grid.cols * ticks_per_step - previous))
+    midi.save(path)
+    return midi
+
+
+def load_sample(path, sample_rate=SAMPLE_RATE):
+    '''WAVを -1.0〜1.0 のモノラルのリストとして読む（サンプリング周波数は変換しない）'''
+    with wave.open(path) as source:
+        channels = source.getnchannels()
+        width = source.getsampwidth()
+        if source.getframerate() != sample_rate:
+            raise ValueError(f"{path}: {source.getframerate()} Hz is not supported (expected {sample_rate} Hz)")
+        data = source.readframes(source.getnframes())
+
+    if width == 1:
+        values = [value - 128 for value in data]
+    elif width == 3:
+        values = [int.from_bytes(data[i:i + 3], 'little', signed=True) for i in range(0, len(data), 3)]
+    else:
+        values = array({2: 'h', 4: 'i'}[width])
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+    scale = 1.0 / (channels * (1 << (width * 8 - 1)))
+    return [sum(values[i:i + channels]) * scale for i in range(0, len(values), channels)]
+
+
+class Synth:
+    '''倍音を少し足したサイン波に、減衰するエンベロープをかけた簡単な音源。同じ長さの音は使い回す'''
+    def __init__(self, sample_rate=SAMPLE_RATE, volume=0.2, release=0.02):
+        self.sample_rate = sample_rate
+        self.volume = volume
+        self.release = int(release * sample_rate)
+        self._cache = {}
+
+    def tone(self, note, frames):
+        key = (note, frames)
+        if key not in self._cache:
+            step = 2 * math.pi * 440.0 * 2 ** ((note - 69) / 12) / self.sample_rate
+            decay = -3.0 / max(frames, 1)
+            release_start = max(frames - self.release, 0)
+            samples = []
+            for i in range(frames):
+                phase = step * i
+                level = self.volume * math.exp(decay * i)
+                if i >= release_start:
+                    level *= (frames - i) / self.release
+                samples.append(level * (math.sin(phase) + 0.3 * math.sin(2 * phase)))
+            self._cache[key] = samples
+        return self._cache[key]
+
+
+class OfflineRenderer:
+    '''
+    ドラムのサンプルとシンセの音を足し合わせてWAVを作る
+    サンプルとシンセの音は一度だけ作って、パターンをまたいで使い回す
+    '''
+    def __init__(self, sample_rate=SAMPLE_RATE, drum_volume=0.8, sample_dir=SAMPLE_DIR):
+        self.sample_rate = sample_rate
+        self.drum_volume = drum_volume
+        self.synth = Synth(sample_rate)
+        self.samples = {}
+        for palette_id, entry in DRUM_SAMPLES.items():
+            path = entry["sample"]
+            if not os.path.isabs(path):
+                path = os.path.join(sample_dir, path)
+            self.samples[palette_id] = [value * drum_volume for value in load_sample(path, sample_rate)]
+
+    def mix(self, grid, step_ms, loops=1):
+        '''-1.0〜1.0 のモノラルのリストを返す。最後のドラムの余韻も含める'''
+        step_frames = int(self.sample_rate * step_ms / 1000)
+        length = grid.cols * step_frames * loops
+        tail = max((len(sample) for sample in self.samples.values()), default=0)
+        out = [0.0] * (length + tail)
+
+        def add(start, sound):
+            end = start + len(sound)
+            out[start:end] = map(operator.add, out[start:end], sound)
+
+        for loop in range(loops):
+            offset = loop * grid.cols * step_frames
+            for row in range(grid.rows):
+                for col, run, palette_id in grid.runs(row):
+                    start = offset + col * step_frames
+                    if IS_DRUM[palette_id]:
+                        add(start, self.samples[palette_id])
+                    else:
+                        add(start, self.synth.tone(NOTE_TABLE[palette_id], run * step_frames))
+        return out
+
+    def render_wav(self, grid, step_ms, path, loops=1):
+        '''16bitモノラルのWAVに書き出す（はみ出した値は切り詰める）'''
+        samples = array('h', (int(max(-1.0, min(1.0, value)) * 32767)
+                              for value in self.mix(grid, step_ms, loops)))
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        with wave.open(path, 'wb') as target:
+            target.setnchannels(1)
+            target.setsampwidth(2)
+            target.setframerate(self.sample_rate)
+            target.writeframes(samples.tobytes())
+        return len(samples) / self.sample_rate
+
+
+def load_pattern(path):
+    if path.endswith(PATTERN_EXT):
+        return load_binary_pattern(path)
+    with open(path) as source:
+        data = json.load(source)
+    return GridModel.from_names(data["grid"]), float(data.get("step_ms", 600))
+
+
+def render_batch(paths, out_dir, loops=1, row_channels=None):
+    '''パターンをまとめて書き出し、(パターン, 曲の長さ秒, かかった秒) のリストを返す'''
+    os.makedirs(out_dir, exist_ok=True)
+    renderer = OfflineRenderer()
+    results = []
+    for path in paths:
+        start = time.perf_counter()
+        grid, step_ms = load_pattern(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        render_midi(grid, step_ms, os.path.join(out_dir, name + '.mid'), row_channels, loops)
+        duration = renderer.render_wav(grid, step_ms, os.path.join(out_dir, name + '.wav'), loops)
+        results.append((path, duration, time.perf_counter() - start))
+    return results
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    out_dir = 'renders'
+    loops = 1
+    if '--out' in args:
+        i = args.index('--out')
+        out_dir = args[i + 1]
+        del args[i:i + 2]
+    if '--loops' in args:
+        i = args.index('--loops')
+        loops = int(args[i + 1])
+        del args[i:i + 2]
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+    for path, duration, elapsed in render_batch(args, out_dir, loops):
+        print(f"{path}: {duration:.2f} s of audio in {elapsed:.2f} s ({duration / elapsed:.1f}x real time)")
@@ -0,0 +1,138 @@
+'''サーバー側でパターンを正確なクロックで再生するエンジン'''
+import threading
+
+from compiled_sequence import DRUM, NOTE_OFF, NOTE_ON, CompiledSequence
+from sequencer import StepSequencer
+
+
+class PatternPlayer:
+    '''
+    output: MidiOutput
+    active_notes: ActiveNotes
+    worker: AudioWorker（ポートとミキサーへの送信はすべてこのスレッドで行う）
+    play_drum: ドラムのパレット番号を受け取って鳴らす関数
+    on_step: 列を再生したときに呼ばれる関数 on_step(column)（再生位置の通知用）
+    row_channels: 行ごとのMIDIチャンネル
+    load/start/stop/seekはFlaskの複数のスレッドから呼ばれるので、1つのロックで順番に処理する
+    '''
+    def __init__(self, output, active_notes, worker, play_drum, on_step=None, row_channels=None):
+        self.output = output
+        self.active_notes = active_notes
+        self.worker = worker
+        self.play_drum = play_drum
+        self.on_step = on_step
+        self.row_channels = row_channels
+        self.grid = None
+        self.sequence = None
+        self.sequencer = None
+        self.step_ms = None
+        self.column = 0  # 再生中は最後に再生した列、停止中は次に再生を始める列
+        self._lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return self.sequencer is not None and self.sequencer.is_running
+
+    def load(self, grid, step_ms):
+        '''
+        パターン（GridModel）とテンポを読み込む。再生中なら拍を保ったまま続ける
+        列数とテンポが同じならクロックはそのままで、次の列から新しいパターンを鳴らす
+        '''
+        with self._lock:
+            sequence = CompiledSequence(grid, self.row_channels)
+            running = self.is_running
+            if running:
+                # 前のパターンで鳴っている音は新しいパターンのnote_offでは止まらないので、ここで止める
+                # 今の列で新しいパターンも同じ音を鳴らしているなら、そのまま続ける
+                keep = sequence.sounding(self.column) if self.column < grid.cols else ()
+                self.worker.submit(self.active_notes.release_all, self.output, False, keep)
+            same_clock = (self.sequencer is not None and grid.cols == self.grid.cols
+                          and step_ms == self.step_ms)
+            self.grid = grid
+            self.sequence = sequence  # _stepは列ごとにself.sequenceを読む
+            self.step_ms = step_ms
+            if same_clock:
+                return
+
+            next_time = None
+            if running:
+                next_time = self.sequencer.next_step_time()
+                self.sequencer.stop()
+            self.sequencer = self._new_sequencer(grid.cols, step_ms)
+            self.column = min(self.column, grid.cols - 1)
+            if running:
+                # 次の列は前のシーケンサーで鳴るはずだった時刻に鳴らす
+                column = (self.column + 1) % grid.cols
+                self.sequencer.start(column, next_time - column * self.sequencer.step_duration)
+
+    def start(self):
+        with self._lock:
+            if self.sequencer is None or self.is_running:
+                return
+            self.sequencer.start(self.column)
+
+    def stop(self):
+        '''停止して鳴っている音を止める。次の再生は先頭から'''
+        with self._lock:
+            if self.sequencer is None:
+                return
+            self.sequencer.stop()
+            self.column = 0
+            self.worker.submit(self.active_notes.release_all, self.output)
+
+    def seek(self, column):
+        '''指定した列に移動する。再生中ならその列から鳴らし直す'''
+        with self._lock:
+            if self.grid is None:
+                return
+            column %= self.grid.cols
+            running = self.is_running
+            if running:
+                self.sequencer.stop()
+                self.worker.submit(self.active_notes.release_all, self.output, False)
+            self.column = column
+            if running:
+                self.sequencer.start(column)
+
+    def state(self):
+        with self._lock:
+            return {
+                "playing": self.is_running,
+                "column": self.column,
+                "cols": self.grid.cols if self.grid is not None else 0,
+                "step_ms": self.step_ms,
+                "timing": self.sequencer.timing_report() if self.sequencer is not None else None,
+            }
+
+    def _new_sequencer(self, cols, step_ms):
+        sequencer = StepSequencer(cols, step_ms * cols, lambda column: self._step(sequencer, column))
+        return sequencer
+
+    def _step(self, sequencer, column):
+        # シーケンサーのスレッドから呼ばれる。送信はワーカーに任せてすぐ戻る
+        # stop/loadがロックを持ったままこのスレッドの終了を待つことがあるので、止められたら諦める
+        while not self._lock.acquire(timeout=0.001):
+            if sequencer.stopping:
+                return
+        try:
+            if sequencer is not self.sequencer or sequencer.stopping:
+                return
+            self.column = column
+            self.worker.submit(self._emit, self.sequence, column)
+        finally:
+            self._lock.release()
+        if self.on_step is not None:
+            self.on_step(column)
+
+    def _emit(self, sequence, column):
+        if column == 0:
+            # 周の頭では続いている音をすべて止める（編集で終わりを失った音を残さない）
+            self.active_notes.release_all(self.output, False)
+        for tick, kind, row, channel, value in sequence.events_for_step(column):
+            if kind == NOTE_ON:
+                self.active_notes.note_on(self.output, value, 100, channel)
+            elif kind == NOTE_OFF:
+                self.active_notes.note_off(self.output, value, channel)
+            elif kind == DRUM:
+                self.play_drum(value)
+        self.output.flush()
@@ -0,0 +1,190 @@
+'''パターンを小さなバイナリ形式で保存し、mmapで読み込む。パターンの一覧は索引ファイルに持つ
+
+ファイルの形式（ビッグエンディアン）:
+    ヘッダー: マジック b'PPAT', 形式のバージョン, 対応表のバージョン, 行数, 列数, 1列の長さ(ms)
+    本体: 行数×列数バイトのパレット番号（行ごとに並ぶ。GridModel.cellsと同じ並び）
+'''
+import json
+import math
+import mmap
+import os
+import re
+import struct
+from array import array
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windowsでは索引のロックをしない
+    fcntl = None
+
+from grid_model import MAPPING_VERSION, PALETTE_NAMES, GridModel
+
+MAGIC = b'PPAT'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('!4sBBHHf')
+PATTERN_EXT = '.ppat'
+PATTERN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'patterns')
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+
+
+def save_pattern(grid, step_ms, path):
+    '''一時ファイルに書いてから置き換えるので、途中で止まっても壊れたファイルは残らない'''
+    if not math.isfinite(step_ms) or step_ms <= 0:
+        raise ValueError(f"Invalid step length: {step_ms}")
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as target:
+        target.write(HEADER.pack(MAGIC, FORMAT_VERSION, MAPPING_VERSION, grid.rows, grid.cols, step_ms))
+        target.write(grid.cells.tobytes())
+    os.replace(temp_path, path)
+
+
+def _unpack_header(buffer, path):
+    if len(buffer) < HEADER.size:
+        raise ValueError(f"{path}: too short for a pattern file")
+    magic, version, mapping_version, rows, cols, step_ms = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"{path}: not a pattern file (version {FORMAT_VERSION})")
+    if mapping_version != MAPPING_VERSION:
+        raise ValueError(f"{path}: saved with color mapping version {mapping_version}, "
+                         f"current is {MAPPING_VERSION}")
+    if len(buffer) < HEADER.size + rows * cols:
+        raise ValueError(f"{path}: truncated pattern file")
+    if not math.isfinite(step_ms) or step_ms <= 0:
+        raise ValueError(f"{path}: invalid step length {step_ms}")
+    return rows, cols, step_ms
+
+
+def read_header(path):
+    '''本体を読まずに (行数, 列数, 1列の長さms) を返す'''
+    with open(path, 'rb') as source:
+        head = source.read(HEADER.size)
+        size = os.fstat(source.fileno()).st_size
+    if len(head) < HEADER.size:
+        raise ValueError(f"{path}: too short for a pattern file")
+    magic, version, mapping_version, rows, cols, step_ms = HEADER.unpack(head)
+    if magic != MAGIC or version != FORMAT_VERSION or size < HEADER.size + rows * cols:
+        raise ValueError(f"{path}: not a pattern file (version {FORMAT_VERSION})")
+    if not math.isfinite(step_ms) or step_ms <= 0:
+        raise ValueError(f"{path}: invalid step length {step_ms}")
+    return rows, cols, step_ms
+
+
+def load_pattern(path):
+    '''(GridModel, 1列の長さms) を返す'''
+    with open(path, 'rb') as source, \
+            mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        rows, cols, step_ms = _unpack_header(buffer, path)
+        grid = GridModel(rows, cols)
+        grid.cells = array('B', buffer[HEADER.size:HEADER.size + rows * cols])
+    # 知らないパレット番号は空のセルにする
+    if max(grid.cells, default=0) >= len(PALETTE_NAMES):
+        grid.cells = array('B', (cell if cell < len(PALETTE_NAMES) else 0 for cell in grid.cells))
+    return grid, step_ms
+
+
+class PatternLibrary:
+    '''
+    ディレクトリに保存したパターンと、その索引
+    索引には名前ごとに行数・列数・テンポ・更新時刻を持ち、一覧を出すときにパターンを開かなくてよい
+    サーバーとpygameのアプリが同じディレクトリに保存するので、索引を書き換えるときは
+    ファイルをロックしてディスク上の索引を読み直してから書く
+    directory: 保存先（無ければ作る）
+    '''
+    def __init__(self, directory=PATTERN_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+        self.index = {}
+        self._index_mtime = None
+        # 索引に載っていないファイル（他のプロセスの書き込みが失われた場合など）も拾う
+        self.refresh()
+
+    def path(self, name):
+        if not re.fullmatch(r'[\w\-. ]+', name) or name.startswith('.'):
+            raise ValueError(f"Invalid pattern name: {name!r}")
+        return os.path.join(self.directory, name + PATTERN_EXT)
+
+    def names(self):
+        self._reload()
+        return sorted(self.index)
+
+    def list(self):
+        return [{"name": name, **self.index[name]} for name in self.names()]
+
+    def save(self, name, grid, step_ms):
+        path = self.path(name)
+        save_pattern(grid, step_ms, path)
+        with self._locked():
+            self._reload()
+            self._add(name, path, grid.rows, grid.cols, step_ms)
+            self._write_index()
+
+    def load(self, name):
+        return load_pattern(self.path(name))
+
+    def refresh(self):
+        '''ディレクトリを見直して索引を作り直す。変わっていないファイルはヘッダーも読まない'''
+        with self._locked():
+            self._reload()
+            index = {}
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(PATTERN_EXT):
+                    continue
+                name = entry.name[:-len(PATTERN_EXT)]
+                stat = entry.stat()
+                known = self.index.get(name)
+                if known is not None and known["mtime"] == stat.st_mtime and known["size"] == stat.st_size:
+                    index[name] = known
+                    continue
+                try:
+                    rows, cols, step_ms = read_header(entry.path)
+                except ValueError as e:
+                    print(f"Skipping pattern: {e}")
+                    continue
+                index[name] = self._entry(stat, rows, cols, step_ms)
+            if index != self.index or self._index_mtime is None:
+                self.index = index
+                self._write_index()
+
+    def _add(self, name, path, rows, cols, step_ms):
+        self.index[name] = self._entry(os.stat(path), rows, cols, step_ms)
+
+    @staticmethod
+    def _entry(stat, rows, cols, step_ms):
+        return {"rows": rows, "cols": cols, "step_ms": step_ms, "mtime": stat.st_mtime, "size": stat.st_size}
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reload(self):
+        '''ディスク上の索引が他のプロセスに書き換えられていれば読み直す'''
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._index_mtime:
+            return
+        try:
+            with open(self.index_path) as source:
+                self.index = json.load(source)
+        except (OSError, ValueError):
+            return
+        self._index_mtime = mtime
+
+    def _write_index(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as target:
+            json.dump(self.index, target, indent=1, sort_keys=True)
+        os.replace(temp_path, self.index_path)
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
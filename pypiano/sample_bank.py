@@ -0,0 +1,107 @@
+'''ドラムのサンプルを起動時に読み込み、専用のミキサーチャンネルで鳴らすバンク'''
+import os
+
+import pygame
+
+# サンプルの相対パスはこのディレクトリを基準にする（どこから起動しても同じファイルを読む）
+SAMPLE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SampleBank:
+    '''
+    samples: {キー: {"sample": ファイル, "voices": 同時発音数, "choke": グループ名}}
+             （パレット番号がキーのgrid_model.DRUM_SAMPLESか、色の名前がキーのdrum_color_mapを渡す）
+             voicesとchokeは省略できる
+    voices: voicesを省略したサンプルの同時発音数
+    spare_channels: 予約しないで残すチャンネル数（他の効果音用）
+
+    サンプルごとに専用のチャンネルを予約するので、他の音にチャンネルを取られて音が消えることはない
+    発音数を超えたら一番古い発音を止めて鳴らし直す
+    同じchokeグループのサンプルを鳴らすと、グループの他のサンプルは止まる（オープン/クローズのハイハットなど）
+    '''
+    def __init__(self, samples, sample_dir=SAMPLE_DIR, voices=2, spare_channels=8):
+        if not pygame.mixer.get_init():
+            pygame.mixer.init()
+        self.paths = {}
+        self.sounds = {}
+        self.groups = {}  # グループ名 -> 名前のリスト
+        self._choke = {}  # 名前 -> 同じグループの他の名前
+        self._channels = {}  # 名前 -> 予約したチャンネルのリスト
+        self._next = {}  # 名前 -> 次に使うチャンネルの番号
+        self.triggers = {}
+        self.stolen = 0  # 発音数が足りず、鳴っている音を止めて鳴らし直した数
+        self.choked = 0  # chokeグループで止めた数
+        self.dropped = 0  # 鳴らせなかった数（未登録の名前など）
+
+        counts = {}
+        for name, entry in samples.items():
+            path = entry["sample"]
+            if not os.path.isabs(path):
+                path = os.path.join(sample_dir, path)
+            self.paths[name] = path
+            self.sounds[name] = pygame.mixer.Sound(path)
+            counts[name] = entry.get("voices", voices)
+            self.triggers[name] = 0
+            group = entry.get("choke")
+            if group is not None:
+                self.groups.setdefault(group, []).append(name)
+
+        for members in self.groups.values():
+            for name in members:
+                self._choke[name] = [other for other in members if other != name]
+
+        # 先頭のチャンネルを予約して、Sound.play()に使われないようにする
+        reserved = sum(counts.values())
+        if pygame.mixer.get_num_channels() < reserved + spare_channels:
+            pygame.mixer.set_num_channels(reserved + spare_channels)
+        pygame.mixer.set_reserved(reserved)
+        index = 0
+        for name, count in counts.items():
+            self._channels[name] = [pygame.mixer.Channel(index + i) for i in range(count)]
+            self._next[name] = 0
+            index += count
+
+    def play(self, name, volume=1.0):
+        '''サンプルを鳴らす。鳴らせたらTrueを返す'''
+        channels = self._channels.get(name)
+        if channels is None:
+            self.dropped += 1
+            return False
+        for other in self._choke.get(name, ()):
+            for channel in self._channels[other]:
+                if channel.get_busy():
+                    channel.stop()
+                    self.choked += 1
+
+        # 空いているチャンネルを探し、なければ一番古い発音を使う
+        start = self._next[name]
+        count = len(channels)
+        channel = None
+        for i in range(count):
+            candidate = channels[(start + i) % count]
+            if not candidate.get_busy():
+                channel = candidate
+                self._next[name] = (start + i + 1) % count
+                break
+        if channel is None:
+            channel = channels[start]
+            self._next[name] = (start + 1) % count
+            self.stolen += 1
+        channel.set_volume(volume)
+        channel.play(self.sounds[name])
+        self.triggers[name] += 1
+        return True
+
+    def stop(self):
+        for channels in self._channels.values():
+            for channel in channels:
+                channel.stop()
+
+    def stats(self):
+        return {
+            "triggers": dict(self.triggers),
+            "stolen": self.stolen,
+            "choked": self.choked,
+            "dropped": self.dropped,
+            "reserved_channels": sum(len(channels) for channels in self._channels.values()),
+        }
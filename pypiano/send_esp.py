@@ -1,32 +1,39 @@
 '''アプリで選んだRGB値をESPに送信するコード'''
-import requests
-import json
 import pygame
 import mido
 import sys
+import time
+
+from audio_setup import init_mixer
+from active_notes import ActiveNotes
+from compiled_sequence import DRUM, NOTE_OFF, NOTE_ON, CompiledSequence
+from esp_sender import ESPColorSender, UDPTransport
+from grid_model import (COLOR_TABLE, DRUM_SAMPLES, EMPTY, PALETTE_IDS, GridModel,
+                        color_note_map, drum_color_map)
+from grid_renderer import GridRenderer
+from midi_output import MidiOutput
+from pattern_store import PatternLibrary
+from sample_bank import SampleBank
+from sequencer import StepSequencer
 
 # ESP server URL with the correct endpoint
-esp_url = "http://10.42.0.184:5000/ws"
+esp_host = "10.42.0.184"
+esp_url = f"http://{esp_host}:5000/ws"
+esp_udp_port = 5001
+
+# "http": one JSON POST per palette click
+# "udp": 4-byte datagrams over one open socket, also streaming the color of every step
+esp_transport = "http"
+
+# Colors are sent from a background thread so the event loop never waits on the network
+if esp_transport == "udp":
+    esp_sender = ESPColorSender(transport=UDPTransport(esp_host, esp_udp_port))
+else:
+    esp_sender = ESPColorSender(esp_url)
 
 # Function to send RGB color data to ESP
 def send_color_to_esp(r, g, b):
-    color_data = {
-        "r": r,
-        "g": g,
-        "b": b
-    }
-    try:
-        # Sending POST request to the ESP
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(esp_url, headers=headers, json=color_data)
-
-        # Print the response from the server
-        if response.status_code == 200:
-            print("Successfully sent color data:", response.text)
-        else:
-            print(f"Failed to send color data. Status code: {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending data to ESP: {e}")
+    esp_sender.send(r, g, b)
 
 # Pygame initialization
 pygame.init()
@@ -39,39 +46,19 @@ cols = 64
 cell_width = canvas_width // cols
 cell_height = 80
 
-# Color and note mapping
-color_note_map = {
-    "Red": {"note": 60, "color": (255, 0, 0)},  # C4
-    "Orange-pink": {"note": 67, "color": (255, 153, 102)},  # G4 (#FF9966)
-    "Yellow": {"note": 62, "color": (255, 255, 0)},  # D4
-    "Green": {"note": 69, "color": (0, 255, 0)},  # A4
-    "Whitish-blue": {"note": 64, "color": (224, 255, 255)},  # E4 (#E0FFFF)
-    "Blue, bright": {"note": 66, "color": (0, 0, 255)},  # F#4
-    "Violet": {"note": 61, "color": (238, 130, 238)},  # Db4
-    "Purplish-violet": {"note": 68, "color": (75, 0, 130)},  # Ab4 (Indigo)
-    "Steel color with metallic sheen": {"note": 65, "color": (70, 130, 180)},  # Eb4 (Steel Blue)
-    "Red, dark": {"note": 63, "color": (139, 0, 0)}  # F4
-}
-
-# Drum-specific colors
-drum_color_map = {
-    "White": {"sample": "hat.wav", "color": (255, 255, 255)},
-    "Black": {"sample": "kick.wav", "color": (1, 1, 1)}
-}
-
 # Load sound files (for drums)
-pygame.mixer.init()
-hat_sound = pygame.mixer.Sound('hat.wav')
-kick_sound = pygame.mixer.Sound('kick.wav')
+init_mixer()  # Small mixer buffer, tunable per machine via environment variables
+drum_bank = SampleBank(DRUM_SAMPLES)  # Dedicated mixer channels per sample
 
 # Grid data
-grid = [[None for _ in range(cols)] for _ in range(rows)]
+grid = GridModel(rows, cols)
+sequence = CompiledSequence(grid)  # Compiled playback events
 selected_color = "Red"  # Default selected color
 previous_selected_color = None  # To track the previously selected color
 is_erasing = False
 
 # MIDI initialization
-outport = mido.open_output('IAC Driver My Port1')
+outport = MidiOutput(mido.open_output('IAC Driver My Port1'))
 
 # Window setup
 screen = pygame.display.set_mode((canvas_width +800, canvas_height + 800))  # Extended height for palette
@@ -79,31 +66,9 @@ screen = pygame.display.set_mode((canvas_width +800, canvas_height + 800))  # Ex
 
 pygame.display.set_caption("Interactive Music Grid")
 
-# Draw color palette
-def draw_palette():
-    palette_x = 20
-    palette_y = canvas_height + 10
-    button_size = 50
-
-    for i, (key, value) in enumerate(color_note_map.items()):
-        pygame.draw.rect(screen, value["color"], (palette_x + i * (button_size + 10), palette_y, button_size, button_size))
-
-# Draw grid
-def draw_grid():
-    for row in range(rows):
-        for col in range(cols):
-            color = (255, 255, 255) if grid[row][col] is None else grid[row][col]["color"]
-            pygame.draw.rect(screen, color, (col * cell_width, row * cell_height, cell_width, cell_height))
-            pygame.draw.rect(screen, (0, 0, 0), (col * cell_width, row * cell_height, cell_width, cell_height), 1)
-
-# Draw staves
-def draw_staves():
-    for row in range(2):  # Only the top 2 rows
-        start_y = row * cell_height
-        line_spacing = cell_height // 6
-        for i in range(1, 6):
-            y_pos = start_y + i * line_spacing
-            pygame.draw.line(screen, (0, 0, 0), (0, y_pos), (canvas_width, y_pos), 1)
+# Cache the static grid, staves and palette and redraw only what changed
+renderer = GridRenderer(screen, rows, cols, cell_width, cell_height, canvas_width, canvas_height,
+                        [value["color"] for value in color_note_map.values()])
 
 # Handle mouse click on grid
 def handle_mouse_click(pos):
@@ -116,98 +81,108 @@ def handle_mouse_click(pos):
 
     if row < rows:
         if is_erasing:
-            grid[row][col] = None
+            grid.set(row, col, EMPTY)
         else:
             if row < 2 and selected_color in color_note_map:
-                grid[row][col] = {"key": selected_color, "color": color_note_map[selected_color]["color"]}
+                grid.set(row, col, PALETTE_IDS[selected_color])
             elif row == 2 and selected_color in drum_color_map:
-                grid[row][col] = {"key": selected_color, "color": drum_color_map[selected_color]["color"]}
+                grid.set(row, col, PALETTE_IDS[selected_color])
+
+        sequence.update_cell(row, col)
+        renderer.mark_cell(row, col, grid.color(row, col))
 
 # Handle palette click
+palette_keys = list(color_note_map)
+
 def handle_palette_click(pos):
     global previous_selected_color
-    palette_x = 20
-    palette_y = canvas_height + 10
-    button_size = 50
-    for i, key in enumerate(color_note_map.keys()):
-        palette_rect = pygame.Rect(palette_x + i * (button_size + 10), palette_y, button_size, button_size)
-        if palette_rect.collidepoint(pos):
-            if key != previous_selected_color:
-                previous_selected_color = key
-                r, g, b = color_note_map[key]["color"]
-                send_color_to_esp(r, g, b)  # Send RGB data when a new color is selected
-            return key
-    return None
+    i = renderer.palette_at(pos)
+    if i is None:
+        return None
+    key = palette_keys[i]
+    if key != previous_selected_color:
+        previous_selected_color = key
+        r, g, b = color_note_map[key]["color"]
+        send_color_to_esp(r, g, b)  # Send RGB data when a new color is selected
+    return key
 
 # 列の再生
-playing_notes = [None for _ in range(rows)]  # To store the currently playing note for each row
+active_notes = ActiveNotes()  # Sounding notes, always released on stop, clear and exit
 
 # Play column
 def play_column(col):
-    for row in range(rows):
-        cell = grid[row][col]
-        previous_cell = grid[row][col - 1] if col > 0 else None  # Check the previous column
-
-        if cell:
-            if row < 2:  # For musical notes
-                midi_note = color_note_map[cell["key"]]["note"]
-
-                # If this cell has the same note as the previous one, sustain the note
-                if previous_cell and previous_cell == cell:
-                    continue  # Do nothing, continue the sustain
-
-                # If a new note starts, play it
-                outport.send(mido.Message('note_on', note=midi_note, velocity=100))
-                playing_notes[row] = midi_note  # Track the playing note for this row
-            elif row == 2:  # For drum sounds
-                if cell["key"] == "White":
-                    hat_sound.play()
-                elif cell["key"] == "Black":
-                    kick_sound.play()
-        else:
-            # If there was a note playing in the previous column, stop it
-            if playing_notes[row]:
-                outport.send(mido.Message('note_off', note=playing_notes[row], velocity=100))
-                playing_notes[row] = None  # Reset the playing note
-
-# 再生バーの描画
-def draw_playback_bar(position):
-    bar_color = (255, 255, 0, 128)  # 半透明の黄色
-    pygame.draw.rect(screen, bar_color, (position * canvas_width, 0, cell_width, canvas_height))
+    # Sustained runs are merged at compile time, so just walk the events for this step
+    for tick, kind, row, channel, value in sequence.events_for_step(col):
+        if kind == NOTE_ON:
+            active_notes.note_on(outport, value, 100, channel)
+        elif kind == NOTE_OFF:
+            active_notes.note_off(outport, value, channel)
+        elif kind == DRUM:
+            drum_bank.play(value)
+    outport.flush()  # Send all messages of this step at once
 
 # グリッドのリセット
 def clear_grid():
-    global grid
-    grid = [[None for _ in range(cols)] for _ in range(rows)]
+    grid.clear()
+    sequence.compile()
+    active_notes.release_all(outport)
+    renderer.rebuild(grid)
 
 # 音の再生処理
-def play_sounds(progress):
-    column = int(progress * cols)
-
+def play_sounds(column):
     # If at the start, reset any sustained notes
     if column == 0:
-        for row in range(rows):
-            if playing_notes[row]:
-                outport.send(mido.Message('note_off', note=playing_notes[row], velocity=100))
-                playing_notes[row] = None  # Reset all playing notes
+        active_notes.release_all(outport, all_notes_off=False)
+
+    # Stream the color of the top-most filled cell at sequencer rate
+    if esp_transport == "udp":
+        for row, cell in enumerate(grid.column(column)):
+            if cell != EMPTY:
+                send_color_to_esp(*COLOR_TABLE[cell])
+                break
 
     play_column(column)
 
 # Main loop
 running = True
-is_playing = False
 clock = pygame.time.Clock()
 
 # Playback interval and progress speed
 play_interval = 2000  # 2000ms for one loop
-last_time = pygame.time.get_ticks()
 
-while running:
-    screen.fill((255, 255, 255))
-    draw_grid()
-    draw_staves()
-    draw_palette()  # Draw color palette
+# Saved patterns (S saves, a pattern name on the command line opens it)
+library = PatternLibrary()
+
+def save_pattern():
+    name = time.strftime('%Y%m%d-%H%M%S')
+    library.save(name, grid, play_interval / cols)
+    print("Saved pattern:", name)
 
+def open_pattern(name):
+    global play_interval
+    try:
+        loaded, step_ms = library.load(name)
+    except FileNotFoundError:
+        print("Pattern not found:", name)
+        return
+    except ValueError as e:
+        print("Cannot open pattern:", e)
+        return
+    if (loaded.rows, loaded.cols) != (rows, cols):
+        print(f"Cannot open {name}: it is a {loaded.rows}x{loaded.cols} pattern")
+        return
+    grid.cells = loaded.cells
+    sequence.compile()
+    play_interval = step_ms * cols
+
+if len(sys.argv) > 1:
+    open_pattern(sys.argv[1])
+
+sequencer = StepSequencer(cols, play_interval, play_sounds)
+
+renderer.rebuild(grid)
+
+while running:
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             running = False
@@ -219,26 +194,25 @@ while running:
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_c:
                 clear_grid()
+            elif event.key == pygame.K_s:
+                save_pattern()
             elif event.key == pygame.K_SPACE:
-                is_playing = not is_playing
-
-    # Playback
-    if is_playing:
-        current_time = pygame.time.get_ticks()
-        elapsed_time = current_time - last_time
-
-        # Smoothly progress playback bar position
-        progress = (elapsed_time % play_interval) / play_interval
-        draw_playback_bar(progress)
-
-        # Play sounds
-        play_sounds(progress)
-
-        if elapsed_time >= play_interval:
-            last_time = current_time
+                sequencer.toggle()
+                if not sequencer.is_running:
+                    active_notes.release_all(outport)  # Stop hanging notes when the transport stops
 
-    pygame.display.flip()
+    # Move the playback bar and update only the changed parts of the screen
+    renderer.set_playback_bar(sequencer.progress() if sequencer.is_running else None)
+    renderer.present()
     clock.tick(60)
 
+sequencer.stop()
+active_notes.close()
+print("Step timing error:", sequencer.timing_report())
+print("MIDI output:", outport.stats())
+print("Drums:", drum_bank.stats())
+esp_sender.close()
+print(f"ESP colors sent: {esp_sender.sent}, failed: {esp_sender.failed}, coalesced: {esp_sender.coalesced}")
+outport.close()
 pygame.quit()
 sys.exit()
\ No newline at end of file
@@ -0,0 +1,148 @@
+'''描画ループから独立したステップシーケンサーのクロック'''
+import math
+import threading
+import time
+from collections import deque
+
+
+class ColumnTracker:
+    '''
+    再生位置が新しい列に入ったときだけ、その列を1回だけ発火させる
+    cols: 1周の列数
+    max_catch_up: 遅れたときに一度に追いかける最大ステップ数（既定は1周分）
+    '''
+    def __init__(self, cols, max_catch_up=None):
+        self.cols = cols
+        self.max_catch_up = cols if max_catch_up is None else max_catch_up
+        self.last_step = -1
+        self.caught_up = 0  # 遅れを取り戻すために後から発火したステップ数
+        self.skipped = 0  # 遅れすぎて発火しなかったステップ数
+
+    def reset(self, last_step=-1):
+        self.last_step = last_step
+
+    def advance(self, step):
+        '''開始からの通しステップ番号 step までに新しく入った列を順番に返す'''
+        if step <= self.last_step:
+            return []
+        first = self.last_step + 1
+        if step - first + 1 > self.max_catch_up:
+            self.skipped += step - first + 1 - self.max_catch_up
+            first = step - self.max_catch_up + 1
+        self.caught_up += step - first
+        self.last_step = step
+        return [s % self.cols for s in range(first, step + 1)]
+
+
+class StepSequencer:
+    '''
+    cols: 1周の列数
+    play_interval: 1周にかける時間（ミリ秒）
+    on_step: 列の発火時刻に呼ばれる関数 on_step(column)
+    history: タイミング誤差を保持するステップ数
+    '''
+    # この時間より長く待つときはsleepし、残りはスピンで合わせる（秒）
+    spin_threshold = 0.002
+
+    def __init__(self, cols, play_interval, on_step, history=1024):
+        if cols <= 0 or not math.isfinite(play_interval) or play_interval <= 0:
+            raise ValueError(f"Invalid sequencer timing: {cols} columns in {play_interval} ms")
+        self.cols = cols
+        self.play_interval = play_interval
+        self.on_step = on_step
+        self.step_duration = play_interval / 1000 / cols
+        self.tracker = ColumnTracker(cols)
+        self.timing_errors = deque(maxlen=history)  # 各ステップの予定時刻とのずれ（秒）
+        self.start_time = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, column=0, start_time=None):
+        '''
+        columnの列から再生を始める
+        start_time: 先頭の列の時刻（perf_counter）。指定するとcolumnはすぐではなく
+                    start_time + column * step_duration に発火する（別のシーケンサーの拍を引き継ぐとき）
+        '''
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        # 途中の列から始めるときは、開始時刻をその列の分だけ前にずらす
+        if start_time is None:
+            start_time = time.perf_counter() - column * self.step_duration
+        self.start_time = start_time
+        self.tracker.reset(column - 1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def stopping(self):
+        '''stopが呼ばれてスレッドが終わるところか'''
+        return self._stop_event.is_set()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def toggle(self):
+        if self.is_running:
+            self.stop()
+        else:
+            self.start()
+
+    def next_step_time(self):
+        '''次の列の発火予定時刻（perf_counter）'''
+        return self.start_time + (self.tracker.last_step + 1) * self.step_duration
+
+    def progress(self):
+        '''1周の中での現在位置（0.0〜1.0）を返す。再生バーの描画用'''
+        if self.start_time is None:
+            return 0.0
+        loop = self.play_interval / 1000
+        return ((time.perf_counter() - self.start_time) % loop) / loop
+
+    def _wait_until(self, target):
+        # 大部分はsleepで待ち、最後の数ミリ秒はスピンして発火時刻に合わせる
+        while True:
+            remaining = target - time.perf_counter()
+            if remaining <= 0:
+                return True
+            if remaining > self.spin_threshold:
+                if self._stop_event.wait(remaining - self.spin_threshold):
+                    return False
+            elif self._stop_event.is_set():
+                return False
+
+    def _run(self):
+        while True:
+            # 開始時刻からの絶対時刻で次のステップを求めるので誤差が蓄積しない
+            next_step = self.tracker.last_step + 1
+            target = self.start_time + next_step * self.step_duration
+            if not self._wait_until(target):
+                break
+            now = time.perf_counter()
+            self.timing_errors.append(now - target)
+            # 起床が遅れて複数の列をまたいだ場合も、入った列を順番に1回ずつ発火する
+            step = max(next_step, int((now - self.start_time) / self.step_duration))
+            for column in self.tracker.advance(step):
+                self.on_step(column)
+
+    def timing_report(self):
+        '''計測したステップごとのタイミング誤差（ミリ秒）を集計して返す'''
+        if not self.timing_errors:
+            return {"steps": 0, "mean_ms": 0.0, "max_ms": 0.0,
+                    "caught_up": 0, "skipped": 0}
+        errors = [e * 1000 for e in self.timing_errors]
+        return {
+            "steps": len(errors),
+            "mean_ms": sum(errors) / len(errors),
+            "max_ms": max(errors),
+            "caught_up": self.tracker.caught_up,
+            "skipped": self.tracker.skipped,
+        }
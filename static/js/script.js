@@ -11,27 +11,12 @@ const cellHeight = 80; // 固定のセル高さ
 // グリッドデータの初期化
 let grid = Array(rows).fill().map(() => Array(cols).fill(null));
 
-// カラーパレットと音のリスト
-const colorNoteMap = {
-    "Red": { note: "C4", color: "red" },
-    "Orange-pink": { note: "G4", color: "#FF9966" },
-    "Yellow": { note: "D4", color: "yellow" },
-    "Green": { note: "A4", color: "green" },
-    "Whitish-blue": { note: "E4", color: "#E0FFFF" }, // Light Cyan
-    "Blue, bright": { note: "F#4", color: "blue" },
-    "Violet": { note: "Db4", color: "violet" },
-    "Purplish-violet": { note: "Ab4", color: "indigo" },
-    "Steel color with metallic sheen": { note: "Eb4", color: "#4682B4" }, // Steel Blue
-    "Red, dark": { note: "F4", color: "darkred" }
-};
-
-const drumColorMap = {
-    "White": { sample: "hat", color: "white" },
-    "Black": { sample: "kick", color: "black" }
-};
-
-const mainColors = Object.keys(colorNoteMap);
-const drumColors = Object.keys(drumColorMap);
+// カラーパレットと音のリスト（サーバーの /palette から受け取る。pypiano/grid_model.py と共通）
+let colorNoteMap = {};
+let drumColorMap = {};
+let mainColors = [];
+let drumColors = [];
+let noteDuration = 0.25; // 1音の長さ（秒）。テンポによらず一定で、サーバーのnote_durationと揃える
 
 let selectedColor = null; // 選択された色（キー）
 let selectedPalette = null; // 選択されたパレット（"main" または "drum"）
@@ -45,33 +30,57 @@ const clearButton = document.getElementById('clearButton');
 const saveButton = document.getElementById('saveButton');
 const playButton = document.getElementById('playButton');
 
-// メインパレットの生成
-mainColors.forEach(key => {
-    const colorInfo = colorNoteMap[key];
-    const colorBtn = document.createElement('button');
-    colorBtn.className = 'color-button';
-    colorBtn.style.backgroundColor = colorInfo.color;
-    colorBtn.addEventListener('click', () => {
-        selectedColor = key;
-        selectedPalette = "main";
-        eraserMode = false;
+// パレットの生成
+function buildPalettes() {
+    mainColors.forEach(key => {
+        const colorInfo = colorNoteMap[key];
+        const colorBtn = document.createElement('button');
+        colorBtn.className = 'color-button';
+        colorBtn.style.backgroundColor = colorInfo.color;
+        colorBtn.addEventListener('click', () => {
+            selectedColor = key;
+            selectedPalette = "main";
+            eraserMode = false;
+        });
+        mainPaletteDiv.appendChild(colorBtn);
     });
-    mainPaletteDiv.appendChild(colorBtn);
-});
 
-// ドラムパレットの生成
-drumColors.forEach(key => {
-    const colorInfo = drumColorMap[key];
-    const colorBtn = document.createElement('button');
-    colorBtn.className = 'drum-button';
-    colorBtn.style.backgroundColor = colorInfo.color;
-    colorBtn.addEventListener('click', () => {
-        selectedColor = key;
-        selectedPalette = "drum";
-        eraserMode = false;
+    drumColors.forEach(key => {
+        const colorInfo = drumColorMap[key];
+        const colorBtn = document.createElement('button');
+        colorBtn.className = 'drum-button';
+        colorBtn.style.backgroundColor = colorInfo.color;
+        colorBtn.addEventListener('click', () => {
+            selectedColor = key;
+            selectedPalette = "drum";
+            eraserMode = false;
+        });
+        drumPaletteDiv.appendChild(colorBtn);
     });
-    drumPaletteDiv.appendChild(colorBtn);
-});
+}
+
+// 対応表を受け取ってパレットとドラムサンプルを用意する
+function applyPalette(table) {
+    for (const entry of table.palette) {
+        if (entry.drum) {
+            drumColorMap[entry.name] = { id: entry.id, sample: entry.sample, color: entry.color };
+        } else {
+            colorNoteMap[entry.name] = {
+                id: entry.id,
+                note: Tone.Frequency(entry.note, "midi").toNote(),
+                color: entry.color
+            };
+        }
+    }
+    if (table.note_duration) {
+        noteDuration = table.note_duration;
+    }
+    mainColors = Object.keys(colorNoteMap);
+    drumColors = Object.keys(drumColorMap);
+    buildPalettes();
+    loadDrumPlayers();
+    drawGrid();
+}
 
 // コントロールボタンのイベント
 eraserButton.addEventListener('click', () => {
@@ -86,6 +95,11 @@ clearButton.addEventListener('click', () => {
 });
 
 saveButton.addEventListener('click', () => {
+    // 名前を付ければパターンをサーバーのライブラリにも保存する
+    const name = prompt('パターンの名前（空ならPNGだけ保存）');
+    if (name) {
+        savePatternToServer(name);
+    }
     const link = document.createElement('a');
     link.download = 'grid.png';
     link.href = canvas.toDataURL();
@@ -122,101 +136,387 @@ canvas.addEventListener('click', (e) => {
         }
         // 適切なパレットが選択されていない場合は何もしない
     }
-    drawGrid();
+    drawCell(x, y);
+    if (useServerPlayback && isPlaying) {
+        sendPatternToServer();
+    }
 });
 
-// グリッドの描画
-function drawGrid() {
-    ctx.clearRect(0, 0, canvas.width, canvas.height);
+// 静的なレイヤー（セルの枠線と五線譜）はオフスクリーンのキャンバスに一度だけ描く
+const staticLayer = document.createElement('canvas');
+staticLayer.width = canvas.width;
+staticLayer.height = canvas.height;
+const staticCtx = staticLayer.getContext('2d');
 
-    // セルの描画
+function buildStaticLayer() {
+    staticCtx.strokeStyle = '#000';
     for (let y = 0; y < rows; y++) {
         for (let x = 0; x < cols; x++) {
-            const cell = grid[y][x];
-            if (cell) {
-                let color;
-                if (cell.palette === "main") {
-                    color = colorNoteMap[cell.key].color;
-                } else if (cell.palette === "drum") {
-                    color = drumColorMap[cell.key].color;
-                }
-                ctx.fillStyle = color;
-                ctx.fillRect(x * cellWidth, y * cellHeight, cellWidth, cellHeight);
-            }
-            ctx.strokeStyle = '#000';
-            ctx.strokeRect(x * cellWidth, y * cellHeight, cellWidth, cellHeight);
+            staticCtx.strokeRect(x * cellWidth, y * cellHeight, cellWidth, cellHeight);
+        }
+    }
+    drawStaves(staticCtx);
+}
+
+let highlightedColumn = null; // ハイライト中の列
+
+// 1つのセルだけを描き直す
+function drawCell(x, y) {
+    const left = x * cellWidth;
+    const top = y * cellHeight;
+    ctx.clearRect(left, top, cellWidth, cellHeight);
+
+    const cell = grid[y][x];
+    if (cell) {
+        let color;
+        if (cell.palette === "main") {
+            color = colorNoteMap[cell.key].color;
+        } else if (cell.palette === "drum") {
+            color = drumColorMap[cell.key].color;
         }
+        ctx.fillStyle = color;
+        ctx.fillRect(left, top, cellWidth, cellHeight);
     }
+    ctx.drawImage(staticLayer, left, top, cellWidth, cellHeight, left, top, cellWidth, cellHeight);
 
-    // 五線譜の描画
-    drawStaves();
+    if (x === highlightedColumn) {
+        ctx.fillStyle = 'rgba(255, 255, 0, 0.3)';
+        ctx.fillRect(left, top, cellWidth, cellHeight);
+    }
+}
+
+function drawColumn(x) {
+    for (let y = 0; y < rows; y++) {
+        drawCell(x, y);
+    }
+}
+
+// グリッド全体の描画（初期化とクリアのときだけ）
+function drawGrid() {
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    for (let x = 0; x < cols; x++) {
+        drawColumn(x);
+    }
 }
 
 // 五線譜の描画
-function drawStaves() {
-    ctx.strokeStyle = '#000';
+function drawStaves(target) {
+    target.strokeStyle = '#000';
     for (let y = 0; y < 2; y++) { // 最初の2行のみ
         const startY = y * cellHeight;
         const lineSpacing = cellHeight / 6;
         for (let i = 1; i <= 5; i++) {
             const yPos = startY + i * lineSpacing;
-            ctx.beginPath();
-            ctx.moveTo(0, yPos);
-            ctx.lineTo(canvas.width, yPos);
-            ctx.stroke();
+            target.beginPath();
+            target.moveTo(0, yPos);
+            target.lineTo(canvas.width, yPos);
+            target.stroke();
         }
     }
 }
 
 // 再生ロジック
+// 音はオーディオクロック上で少し先に予約し、再生位置はrequestAnimationFrameで別に描く
 let currentColumn = 0;
-let playbackInterval;
+let stepEventId = null;
+let playheadQueue = []; // 予約した列と、その列が鳴るオーディオ時刻
+let stepMs = 600; // 1ステップの長さ（ミリ秒）
 
-function startPlayback() {
-    playbackInterval = setInterval(() => {
-        // 現在の列をハイライト
-        drawGrid();
-        ctx.fillStyle = 'rgba(255, 255, 0, 0.3)';
-        ctx.fillRect(currentColumn * cellWidth, 0, cellWidth, canvas.height);
+// 1ステップ = 16分音符になるようにテンポを合わせる
+function setTempo(ms) {
+    stepMs = ms;
+    Tone.Transport.bpm.value = 15000 / stepMs;
+    if (useServerPlayback && isPlaying) {
+        sendPatternToServer();
+    }
+}
+
+const tempoInput = document.getElementById('tempoInput');
+if (tempoInput) {
+    tempoInput.value = stepMs;
+    tempoInput.addEventListener('change', () => setTempo(Number(tempoInput.value)));
+}
 
-        // 音の再生
-        for (let y = 0; y < rows; y++) {
-            const cell = grid[y][currentColumn];
-            if (cell) {
-                playSound(y, cell.key, cell.palette);
+// 再生中の列をハイライト（前の列と新しい列だけを描き直す）
+function highlightColumn(column) {
+    const previous = highlightedColumn;
+    highlightedColumn = column;
+    if (previous !== null && previous !== column) {
+        drawColumn(previous);
+    }
+    if (column !== null) {
+        drawColumn(column);
+    }
+}
+
+// 鳴った時刻に合わせて再生位置を描く
+function drawPlayhead() {
+    if (!isPlaying) {
+        return;
+    }
+    const now = Tone.context.currentTime;
+    let column = null;
+    while (playheadQueue.length > 0 && playheadQueue[0].time <= now) {
+        column = playheadQueue.shift().column;
+    }
+    if (column !== null) {
+        highlightColumn(column);
+    }
+    requestAnimationFrame(drawPlayhead);
+}
+
+function startPlayback() {
+    if (useServerPlayback) {
+        // タイミングはサーバーが管理し、ブラウザは再生位置を描くだけ
+        sendPatternToServer().then(() => fetch('/transport/start', { method: 'POST' }));
+        return;
+    }
+    setTempo(stepMs);
+    currentColumn = 0;
+    playheadQueue = [];
+    // timeはこの列が鳴るオーディオ時刻（現在より先読み分だけ先）
+    stepEventId = Tone.Transport.scheduleRepeat((time) => {
+        const column = currentColumn;
+        if (useServerMidi) {
+            sendColumnToServer(column, (time - Tone.context.currentTime) * 1000);
+        } else {
+            for (let y = 0; y < rows; y++) {
+                const cell = grid[y][column];
+                if (cell) {
+                    playSound(y, cell.key, cell.palette, time);
+                }
             }
         }
-
+        playheadQueue.push({ column: column, time: time });
         currentColumn = (currentColumn + 1) % cols;
-    }, 600); // 600ミリ秒ごとに移動
+    }, '16n');
+    Tone.Transport.start();
+    requestAnimationFrame(drawPlayhead);
 }
 
 function stopPlayback() {
-    clearInterval(playbackInterval);
+    if (useServerPlayback) {
+        fetch('/transport/stop', { method: 'POST' });
+    }
+    Tone.Transport.stop();
+    if (stepEventId !== null) {
+        Tone.Transport.clear(stepEventId);
+        stepEventId = null;
+    }
+    playheadQueue = [];
     currentColumn = 0;
-    drawGrid();
+    highlightColumn(null);
+}
+
+// ボイスプール（行ごとに決まった数のシンセを作っておき、順番に使い回す）
+const voicesPerRow = 4;
+
+class VoicePool {
+    constructor(createVoice, size) {
+        this.voices = Array.from({ length: size }, createVoice);
+        this.next = 0;
+    }
+
+    // 一番前に使ったボイスで鳴らす（まだ鳴っていれば奪う）
+    trigger(note, duration, time) {
+        const voice = this.voices[this.next];
+        this.next = (this.next + 1) % this.voices.length;
+        voice.triggerAttackRelease(note, duration, time);
+    }
+}
+
+const rowVoices = [
+    new VoicePool(() => new Tone.Synth().toDestination(), voicesPerRow), // ピアノシンセ
+    new VoicePool(() => new Tone.MembraneSynth().toDestination(), voicesPerRow) // ベースシンセ
+];
+
+// ドラムサンプルは起動時に一度だけ読み込み、バッファを共有する
+let drumPlayers = null;
+
+function loadDrumPlayers() {
+    drumPlayers = new Tone.Players(
+        Object.fromEntries(drumColors.map(key => [key, `/samples/${drumColorMap[key].sample}`]))
+    ).toDestination();
 }
 
 // 音の再生
-function playSound(row, key, palette) {
-    if (palette === "main") {
+// timeは鳴らすオーディオ時刻（省略時はすぐに鳴らす）
+function playSound(row, key, palette, time) {
+    if (palette === "main" && row < rowVoices.length) {
         const note = colorNoteMap[key].note;
-        if (row === 0) {
-            // ピアノシンセ
-            const synth = new Tone.Synth().toDestination();
-            synth.triggerAttackRelease(note, '8n');
-        } else if (row === 1) {
-            // ベースシンセ
-            const bassSynth = new Tone.MembraneSynth().toDestination();
-            bassSynth.triggerAttackRelease(note, '8n');
-        }
+        rowVoices[row].trigger(note, noteDuration, time);
     } else if (palette === "drum" && row === 2) {
         // ドラムサンプル
-        const sampleName = drumColorMap[key].sample;
-        const player = new Tone.Player(`/static/audio/${sampleName}.wav`).toDestination();
-        player.autostart = true;
+        if (drumPlayers && drumPlayers.loaded) {
+            // 同じサンプルは1ボイスまで（鳴っていれば止めてから鳴らし直す）
+            const player = drumPlayers.player(key);
+            if (player.state === 'started') {
+                player.stop(time);
+            }
+            player.start(time);
+        }
+    }
+}
+
+// 再生の方法（画面のセレクトで切り替える）
+// "browser": Tone.jsで鳴らす / "server-midi": サーバー（app.py）のMIDI出力で鳴らす
+// "server": 再生のタイミングもサーバーに任せる（ブラウザは再生位置を描くだけ）
+let useServerMidi = false;
+let useServerPlayback = false;
+let batchId = 0;
+const batchSentAt = new Map(); // 送信時刻（往復時間の計測用）
+
+// 1列分のイベントを1回のリクエストでまとめて送る（offsetMs後に鳴らしてもらう）
+function sendColumnToServer(column, offsetMs = 0) {
+    const events = [];
+    for (let y = 0; y < rows; y++) {
+        const cell = grid[y][column];
+        if (cell) {
+            events.push({ color: cell.key, type: cell.palette === "main" ? "note" : "drum", offset_ms: offsetMs });
+        }
+    }
+    if (events.length === 0) {
+        return;
+    }
+    batchId++;
+    batchSentAt.set(batchId, performance.now());
+    fetch('/play_batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ id: batchId, events: events }),
+        keepalive: true
+    });
+}
+
+// グリッド全体とテンポをサーバーに送る
+function sendPatternToServer() {
+    return fetch('/pattern', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            grid: grid.map(row => row.map(cell => cell ? cell.key : null)),
+            step_ms: stepMs
+        })
+    });
+}
+
+function savePatternToServer(name) {
+    return fetch(`/patterns/${encodeURIComponent(name)}`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            grid: grid.map(row => row.map(cell => cell ? cell.key : null)),
+            step_ms: stepMs
+        })
+    });
+}
+
+// 保存したパターンを開く（グリッドの大きさが違うときは開かない）
+function loadPatternFromServer(name) {
+    return fetch(`/patterns/${encodeURIComponent(name)}`)
+        .then(response => response.json())
+        .then(data => {
+            if (data.status === 'error') {
+                alert(data.message);
+                return;
+            }
+            if (!data.grid || data.grid.length !== rows || data.grid[0].length !== cols) {
+                console.error('Pattern does not fit the grid:', data);
+                return;
+            }
+            grid = data.grid.map(row => row.map(key => {
+                if (key in colorNoteMap) return { key: key, palette: "main" };
+                if (key in drumColorMap) return { key: key, palette: "drum" };
+                return null;
+            }));
+            setTempo(data.step_ms);
+            if (tempoInput) {
+                tempoInput.value = stepMs;
+            }
+            drawGrid();
+            if (useServerPlayback && isPlaying) {
+                sendPatternToServer();
+            }
+        });
+}
+
+// 保存したパターンを一覧から選んで開く（ページにボタンが無ければ保存ボタンの隣に作る）
+let openButton = document.getElementById('openButton');
+if (!openButton) {
+    openButton = document.createElement('button');
+    openButton.id = 'openButton';
+    openButton.textContent = '開く';
+    saveButton.after(openButton);
+}
+openButton.addEventListener('click', () => {
+    fetch('/patterns')
+        .then(response => response.json())
+        .then(patterns => {
+            const names = patterns
+                .filter(p => p.rows === rows && p.cols === cols)
+                .map(p => p.name);
+            if (names.length === 0) {
+                alert('開けるパターンがありません');
+                return;
+            }
+            const name = prompt(`開くパターンの名前\n${names.join('\n')}`, names[names.length - 1]);
+            if (name) {
+                loadPatternFromServer(name);
+            }
+        });
+});
+
+// サーバーからの応答（往復時間とサーバー側の遅れ）と再生位置を受け取る
+let eventSource = null;
+
+function openEventSource() {
+    eventSource = new EventSource('/events');
+    eventSource.addEventListener('playhead', (e) => {
+        if (isPlaying && useServerPlayback) {
+            highlightColumn(JSON.parse(e.data).column);
+        }
+    });
+    eventSource.addEventListener('ack', (e) => {
+        const ack = JSON.parse(e.data);
+        const sentAt = batchSentAt.get(ack.id);
+        if (sentAt !== undefined) {
+            batchSentAt.delete(ack.id);
+            console.log(`step ${ack.id}: round trip ${(performance.now() - sentAt).toFixed(1)}ms, server late ${ack.late_ms.toFixed(1)}ms`);
+        }
+    });
+}
+
+function setPlaybackMode(mode) {
+    // 再生中なら今の方法で止めてから切り替える
+    if (isPlaying) {
+        playButton.click();
+    }
+    useServerMidi = mode === 'server-midi';
+    useServerPlayback = mode === 'server';
+    if ((useServerMidi || useServerPlayback) && eventSource === null) {
+        openEventSource();
+    }
+}
+
+// 再生の方法のセレクト（ページに無ければ再生ボタンの隣に作る）
+let playbackModeSelect = document.getElementById('playbackMode');
+if (!playbackModeSelect) {
+    playbackModeSelect = document.createElement('select');
+    playbackModeSelect.id = 'playbackMode';
+    for (const [value, label] of [['browser', 'ブラウザで再生'], ['server-midi', 'サーバーのMIDIで再生'], ['server', 'サーバーで再生']]) {
+        const option = document.createElement('option');
+        option.value = value;
+        option.textContent = label;
+        playbackModeSelect.appendChild(option);
     }
+    playButton.after(playbackModeSelect);
 }
+playbackModeSelect.addEventListener('change', () => setPlaybackMode(playbackModeSelect.value));
+setPlaybackMode(playbackModeSelect.value);
 
-// 初期描画
+// 初期描画（パレットは対応表が届いてから作る）
+buildStaticLayer();
 drawGrid();
+fetch('/palette')
+    .then(response => response.json())
+    .then(applyPalette);